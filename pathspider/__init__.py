@@ -288,7 +288,7 @@ class StatusHandler(tornado.websocket.WebSocketHandler):
             self.set_header("Content-Type", "application/json")
             self.write(ansstr)
         elif cmd == 'stats':
-            statistics = self.ps.ecn_results.to_json()
+            statistics = self.ps.ecnclient.aggregate.to_json()
             self.set_header("Content-Type", "application/json")
             self.write(statistics)
         elif cmd == 'savegraph':
@@ -338,7 +338,8 @@ class ClientPool:
         return iter(self.pool.items())
 
 class ControlWeb:
-    def __init__(self, addr, tls_state, resolver_url, probe_urls, ipv, chunk_size):
+    def __init__(self, addr, tls_state, resolver_url, probe_urls, ipv, chunk_size, quorum=None, deadline=None, pipeline=0,
+                 fetch_interval=ecnclient.FETCH_INTERVAL):
         self.ipv = ipv
         self.sockets = set()
 
@@ -346,7 +347,8 @@ class ControlWeb:
 
         self.probe_urls = probe_urls
         self.resolver = resolver.ResolverApi(self.clientpool.get(resolver_url), ipv)
-        self.ecnclient = ecnclient.EcnClient(self.ecn_result_sink, tls_state, probe_urls, ipv)
+        self.ecnclient = ecnclient.EcnClient(self.ecn_result_sink, tls_state, probe_urls, ipv, quorum=quorum, deadline=deadline, pipeline=pipeline,
+                                             partial_sink=self.ecn_result_sink, fetch_interval=fetch_interval)
         self.tbclient = tbclient.TbClient(self.tb_result_sink, tls_state, probe_urls, ipv)
 
         self.chunk_size = chunk_size
@@ -449,6 +451,7 @@ class ControlWeb:
     def ecn_result_sink(self, result, chunk_id):
         for ip, status, res in result.get_ip_and_result():
             self.subjects_map[str(ip)]['ecn'] = status
+            self.subjects_map[str(ip)]['ecn_provisional'] = result.provisional
             self.subjects_map[str(ip)]['ecn_result'] = None#res.to_dict()
             #import pdb; pdb.set_trace()
         self.subjects_changed = True
@@ -489,7 +492,8 @@ class ControlWeb:
         }
 
 class ControlBatch:
-    def __init__(self, tls_state, resolver_url, probe_urls, ipv, chunk_size, report_file, btdht_count=None, hostnames=None, ips=None):
+    def __init__(self, tls_state, resolver_url, probe_urls, ipv, chunk_size, report_file, btdht_count=None, hostnames=None, ips=None,
+                 quorum=None, deadline=None, pipeline=0, fetch_interval=ecnclient.FETCH_INTERVAL):
         self.ipv = ipv
         self.chunk_size = chunk_size
 
@@ -507,7 +511,8 @@ class ControlBatch:
         self.clientpool = ClientPool(tls_state)
 
         self.resolver = resolver.ResolverApi(self.clientpool.get(resolver_url), ipv)
-        self.ecnclient = ecnclient.EcnClient(self.ecn_result_sink, tls_state, probe_urls, ipv)
+        self.ecnclient = ecnclient.EcnClient(self.ecn_result_sink, tls_state, probe_urls, ipv, quorum=quorum, deadline=deadline, pipeline=pipeline,
+                                             partial_sink=self.ecn_result_sink, fetch_interval=fetch_interval)
         self.tbclient = tbclient.TbClient(self.tb_result_sink, tls_state, probe_urls, ipv)
 
     def wait_for_resolver(self):
@@ -612,6 +617,7 @@ class ControlBatch:
     def ecn_result_sink(self, result, chunk_id):
         for ip, status, res in result.get_ip_and_result():
             self.subjects_map[str(ip)]['ecn'] = status
+            self.subjects_map[str(ip)]['ecn_provisional'] = result.provisional
             self.subjects_map[str(ip)]['ecn_result'] = json.loads(res.to_json())
 
     def tb_result_sink(self, ip, graph):
@@ -663,14 +669,16 @@ def run_client(args, config, is_standalone = False):
         btdht_count = args.resolver_btdht
 
     if args.webui:
-        ControlWeb(addr=('localhost', 37100), tls_state=tls_state, resolver_url=resolver_url, probe_urls=probe_urls, ipv=args.ipv, chunk_size=args.chunk_size)
+        ControlWeb(addr=('localhost', 37100), tls_state=tls_state, resolver_url=resolver_url, probe_urls=probe_urls, ipv=args.ipv, chunk_size=args.chunk_size,
+                   quorum=args.quorum, deadline=args.deadline, pipeline=args.pipeline, fetch_interval=args.fetch_interval)
     else:
         if args.report is None:
             print("Error: --report is mandatory for client and standalone operation.")
             exit(-1)
 
         cb = ControlBatch(tls_state=tls_state, resolver_url=resolver_url, probe_urls=probe_urls, ipv=args.ipv, chunk_size=args.chunk_size,
-                          report_file=args.report,
+                          report_file=args.report, quorum=args.quorum, deadline=args.deadline, pipeline=args.pipeline,
+                          fetch_interval=args.fetch_interval,
                           hostnames=hostnames, btdht_count=btdht_count, ips=ips)
 
         cb.perform()
@@ -706,6 +714,10 @@ def main():
                                   help='Use addresses given by this csv file. The program expects the column names ip, port and optionally hostname.')
 
     parser_client.add_argument('--chunk-size', type=int, default=1000, metavar='N', help='Number of addresses sent in a chunk to ecnspider. Default is 1000.')
+    parser_client.add_argument('--quorum', type=int, metavar='K', help='Analyse a chunk provisionally once K probes have returned it, and refine the analysis as the other probes return it. Default is to wait for all probes.')
+    parser_client.add_argument('--pipeline', type=int, default=0, metavar='N', help='Number of further chunks invoked on each probe while it measures one, so it starts the next without delay. Probes queue up to their run_queue setting. Default is 0.')
+    parser_client.add_argument('--fetch-interval', type=float, default=30, metavar='SECONDS', help='Fetch the records merged so far from each probe this often while it measures a chunk; 0 disables fetching. Default is 30.')
+    parser_client.add_argument('--deadline', type=float, metavar='SECONDS', help='Analyse a chunk provisionally once SECONDS have passed since the first probe returned it.')
 
     args = parser.parse_args()
 
@@ -0,0 +1,135 @@
+"""
+Ecnspider2: Qofspider-based tool for measuring ECN-linked connectivity
+Derived from ECN Spider (c) 2014 Damiano Boppart <hat.guy.repo@gmail.com>
+
+Micro-benchmark of the EcnAnalysis classification on synthetic chunks,
+against a per-target loop as EcnAnalysis used to do it. Run from the
+pathspider directory:
+
+    python -m client.analysisbench [--targets N] [--sites N]
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+
+from ipaddress import ip_address
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from .ecnclient import EcnAnalysis, CATEGORIES, SAE, \
+                       RESULT_NOBODYHOME, RESULT_OTHER, RESULT_BROKEN, RESULT_WORKS
+
+def synthetic_chunk(targets, sites, seed=0):
+    """
+    Generate the results of every site for a chunk of targets: most
+    targets work, some are offline, and a few fail with ECN at some sites.
+    One in a thousand targets misses its ECN record at some site.
+    """
+    rng = np.random.RandomState(seed)
+    ips = [ip_address(0x0a000000 + i) for i in range(targets)]
+    online = rng.random_sample(targets) > 0.2
+
+    chunk = {}
+    for site in sites:
+        conn_off = online & (rng.random_sample(targets) > 0.01)
+        conn_on = conn_off & (rng.random_sample(targets) > 0.02)
+        synflags = np.where(rng.random_sample(targets) > 0.3, SAE, 0x12)
+        missing = rng.random_sample(targets) < 0.001
+
+        rows = {'destination.ip4': ips + [ip for ip, m in zip(ips, missing) if not m],
+                'destination.port': [80] * (2 * targets - missing.sum()),
+                'ecnspider.ecnstate': [0] * targets + [1] * (targets - missing.sum()),
+                'connectivity.ip': list(conn_off) + list(conn_on[~missing]),
+                'ecnspider.synflags.rev': [0x12] * targets + list(synflags[~missing])}
+        chunk[site] = pd.DataFrame(rows)
+
+    return chunk
+
+def legacy_classify(compiled_chunk, sites):
+    """Classify targets one by one, as EcnAnalysis used to."""
+    merged = {}
+    for site, chunk in compiled_chunk.items():
+        for ip_addr, result in chunk.groupby('destination.ip4'):
+            if result.shape[0] != 2:
+                continue
+
+            if result.iloc[0]['ecnspider.ecnstate'] == 1:
+                ecn_on, ecn_off = result.iloc[0], result.iloc[1]
+            else:
+                ecn_off, ecn_on = result.iloc[0], result.iloc[1]
+
+            if ecn_off['connectivity.ip'] and ecn_on['connectivity.ip']:
+                conn = RESULT_WORKS
+            elif ecn_off['connectivity.ip'] and not ecn_on['connectivity.ip']:
+                conn = RESULT_BROKEN
+            elif not ecn_off['connectivity.ip'] and not ecn_on['connectivity.ip']:
+                conn = RESULT_NOBODYHOME
+            else:
+                conn = RESULT_OTHER
+
+            merged.setdefault(str(ip_addr), {s: RESULT_NOBODYHOME for s in sites})[site] = conn
+
+    categories = {}
+    for ip, conns in merged.items():
+        codes = list(conns.values())
+        if all(c == RESULT_NOBODYHOME for c in codes):
+            categories[ip] = 'offline'
+        elif all(c == RESULT_WORKS for c in codes):
+            categories[ip] = 'safe'
+        elif all(c == RESULT_BROKEN for c in codes):
+            categories[ip] = 'broken_path'
+        elif all(c in (RESULT_WORKS, RESULT_NOBODYHOME) for c in codes):
+            categories[ip] = 'broken_site'
+        else:
+            categories[ip] = 'broken_other'
+    return categories
+
+def vectorized_classify(compiled_chunk, sites):
+    analysis = EcnAnalysis(sites=sites, compiled_chunk=compiled_chunk, ipv='ip4')
+    return {ip: status for attr, status in CATEGORIES for ip in getattr(analysis, attr).index}
+
+def best_time(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ecnclient analysis.')
+    parser.add_argument('--targets', type=int, default=100000, help='targets per chunk')
+    parser.add_argument('--sites', type=int, default=6, help='number of probes')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per implementation')
+    args = parser.parse_args()
+
+    sites = ['site{}'.format(i) for i in range(args.sites)]
+    chunk = synthetic_chunk(args.targets, sites)
+
+    if legacy_classify(chunk, sites) != vectorized_classify(chunk, sites):
+        raise AssertionError("implementations disagree")
+
+    times = {'legacy': best_time(lambda: legacy_classify(chunk, sites), args.repeat),
+             'vectorized': best_time(lambda: vectorized_classify(chunk, sites), args.repeat)}
+    for name, elapsed in sorted(times.items()):
+        print("{:10s} {:8.3f}s {:10.0f} targets/s".format(name, elapsed, args.targets / elapsed))
+    print("speedup    {:8.1f}x".format(times['legacy'] / times['vectorized']))
+
+if __name__ == '__main__':
+    main()
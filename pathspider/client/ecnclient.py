@@ -1,3 +1,5 @@
+from ipaddress import ip_address
+from array import array
 import collections
 import threading
 import logging
@@ -6,6 +8,8 @@ import pandas as pd
 import numpy as np
 import time
 
+from .polling import PollSchedule
+
 
 # Flags constants
 TCP_CWR = 0x80
@@ -33,16 +37,67 @@ RESULT_OTHER = 1
 RESULT_BROKEN = 2
 RESULT_WORKS = 3
 
+# EcnAnalysis categories, as attribute name and status of its targets
+CATEGORIES = [('offline', 'offline'),
+              ('always_works', 'safe'),
+              ('always_broken', 'broken_path'),
+              ('works_per_site', 'broken_site'),
+              ('other', 'broken_other')]
+
+# bytes per address slot in EcnAggregate, large enough for IPv6
+IP_SLOT = 16
+
+# seconds between checks of the analyzer for chunks to analyse
+ANALYZER_SLEEP = 1
+
+# seconds between fetches of the records a probe merged so far, and
+# between polls for the result of a fetch
+FETCH_INTERVAL = 30
+FETCH_SLEEP = 0.5
+
+# seconds to wait for an outstanding fetch once a measurement is complete
+FETCH_WAIT = 60
+
 EcnJob = collections.namedtuple('EcnJob', ['chunk_id', 'addrs', 'ipv', 'when', 'flavor', 'token'])
 
 class EcnImp:
-    def __init__(self, name, tls_state, url, result_sink):
+    """
+    Measures chunks on one probe, one at a time. With ``pipeline``, up to
+    that many further chunks are invoked while one is measured, and wait
+    in the queue of the probe, so that the probe starts the next chunk as
+    soon as it finished one.
+
+    Every ``fetch_interval`` seconds, the records the probe has merged for
+    the chunk being measured are fetched (see the ecnspider-fetch
+    capability) and passed to ``partial_sink``. The result passed to
+    ``result_sink`` still holds all records of the chunk.
+    """
+
+    def __init__(self, name, tls_state, url, result_sink, pipeline=0, partial_sink=None, fetch_interval=FETCH_INTERVAL):
         self.name = name
         self.queued = collections.deque()
-        self.pending_token = None
-        self.pending = None
+        self.pipeline = pipeline
+        # invoked jobs with their token, oldest first
+        self.inflight = collections.deque()
         self.result_sink = result_sink
 
+        # records fetched so far, by chunk id, and the outstanding fetch
+        self.partial_sink = partial_sink
+        self.fetch_interval = fetch_interval
+        self.fetched = {}
+        self.fetch_token = None
+        self.next_fetch = 0
+
+        # result of the oldest job while its last fetch is collected
+        self.final = None
+        self.final_deadline = 0
+
+        # when to poll for the result of the oldest job, and whether the
+        # capabilities of the probe have to be retrieved (again)
+        self.schedule = PollSchedule()
+        self.next_poll = 0
+        self.stale = True
+
         self.url = url
         self.client = mplane.client.HttpInitiatorClient(tls_state=tls_state)
 
@@ -67,91 +122,187 @@ class EcnImp:
         logger.info("Attempting shutdown...")
         self.running = False
 
-        # interrupt running operations
-        if self.pending_token is not None:
-            logger.info("Interrupting measurement '{}'".format(self.pending_token))
-            self.client.interrupt_capability(self.pending_token)
-            self.pending_token = None
-            self.pending = None
+        # interrupt running and staged operations
+        for job in list(self.inflight):
+            logger.info("Interrupting measurement '{}'".format(job.token))
+            self.client.interrupt_capability(job.token)
+        self.inflight.clear()
 
         logger.info("Shutdown completed")
 
+    @property
+    def pending(self):
+        """The job being measured, if any."""
+        return self.inflight[0] if len(self.inflight) > 0 else None
+
     def is_busy(self):
-        return len(self.queued) > 0 or self.pending is not None
+        return len(self.queued) > 0 or len(self.inflight) > 0
+
+    def invoke(self, job):
+        """
+        Invoke the measurement of a job on the probe.
+
+        :returns: the job with its token, or None if it could not be invoked.
+        """
+        logger = logging.getLogger('ecnclient.imp-'+self.name)
+
+        label = None
+        params = None
+        try:
+            if job.flavor == 'tcp':
+                label = 'ecnspider-'+job.ipv
+                params = { "destination."+job.ipv: [str(addr[0]) for addr in job.addrs],
+                           "destination.port": [int(addr[1]) for addr in job.addrs]}
+            elif job.flavor == 'http':
+                label = 'ecnspider-http-'+job.ipv
+                params = { "destination."+job.ipv: [str(addr[0]) for addr in job.addrs],
+                           "destination.port": [int(addr[1]) for addr in job.addrs],
+                           "ecnspider.hostname": [addr[2] for addr in job.addrs]}
+            elif job.flavor == 'https':
+                label = 'ecnspider-https-'+job.ipv
+                params = { "destination."+job.ipv: [str(addr[0]) for addr in job.addrs],
+                           "destination.port": [int(addr[1]) for addr in job.addrs],
+                           "ecnspider.hostname": [addr[2] for addr in job.addrs]}
+
+            if label is None or params is None:
+                raise ValueError("imp-{}: ecnspider flavor {} is not supported by me.".format(self.name, job.flavor))
+
+            logger.info("Invoking measurement {} of chunk {} (containing {} addresses)".format(label, job.chunk_id, len(job.addrs)))
+            spec = self.client.invoke_capability(label, job.when, params)
+            return job._replace(token=spec.get_token())
+        except KeyError as e:
+            logger.exception("Specified URL does not support '{}' capability.".format(label))
+            self.stale = True
+
+        return None
+
+    def advance(self):
+        """Schedule the first poll for the job the probe measures now."""
+        self.fetch_token = None
+        self.final = None
+        if len(self.inflight) > 0:
+            self.schedule.start(len(self.inflight[0].addrs))
+            self.next_poll = time.monotonic() + self.schedule.next_delay()
+            if self.fetch_interval:
+                self.next_fetch = time.monotonic() + self.fetch_interval
+
+    def fetch(self, job):
+        """
+        Start a fetch of the records merged for job so far or, if one is
+        outstanding, collect its result.
+
+        :returns: False while the fetch is outstanding.
+        """
+        logger = logging.getLogger('ecnclient.imp-'+self.name)
+
+        if self.fetch_token is None:
+            label = 'ecnspider-fetch-'+job.ipv
+            try:
+                spec = self.client.invoke_capability(label, 'now', {'ecnspider.token': job.token})
+            except KeyError:
+                logger.warning("Specified URL does not support '{}' capability, not fetching partial results.".format(label))
+                self.fetch_interval = None
+                return True
+            self.fetch_token = spec.get_token()
+            return False
+
+        result = self.client.result_for(self.fetch_token)
+        if isinstance(result, mplane.model.Receipt):
+            return False
+
+        token, self.fetch_token = self.fetch_token, None
+        if isinstance(result, mplane.model.Result):
+            self.client.forget(token)
+            rows = list(result.schema_dict_iterator())
+            if len(rows) > 0:
+                self.fetched.setdefault(job.chunk_id, []).extend(rows)
+                if self.partial_sink is not None:
+                    self.partial_sink(self.name, rows, job.chunk_id)
+                logger.debug("Fetched {} result rows of chunk id: {}".format(len(rows), job.chunk_id))
+        else:
+            # the measurement has just completed, or failed
+            logger.debug("Fetch for chunk id {} failed: {}".format(job.chunk_id, repr(result)))
+        return True
 
     def worker(self):
         logger = logging.getLogger('ecnclient.imp-'+self.name)
-        logger.info("Getting capabilities from {}".format(self.url))
-        self.client.retrieve_capabilities(self.url)
         logger.info("Started.")
         while self.running:
             try:
-                if not self.paused and self.pending_token is None and len(self.queued) > 0:
-                    self.pending = self.queued.popleft()
-                    label = None
-                    params = None
-                    try:
-                        if self.pending.flavor == 'tcp':
-                            label = 'ecnspider-'+self.pending.ipv
-                            params = { "destination."+self.pending.ipv: [str(addr[0]) for addr in self.pending.addrs],
-                                       "destination.port": [int(addr[1]) for addr in self.pending.addrs]}
-                        elif self.pending.flavor == 'http':
-                            label = 'ecnspider-http-'+self.pending.ipv
-                            params = { "destination."+self.pending.ipv: [str(addr[0]) for addr in self.pending.addrs],
-                                       "destination.port": [int(addr[1]) for addr in self.pending.addrs],
-                                       "ecnspider.hostname": [addr[2] for addr in self.pending.addrs]}
-
-                        if label is None or params is None:
-                            raise ValueError("imp-{}: ecnspider flavor {} is not supported by me.".format(self.name, self.pending.flavor))
-
-                        logger.info("Invoking measurement {} of chunk {} (containing {} addresses)".format(label, self.pending.chunk_id, len(self.pending.addrs)))
-                        spec = self.client.invoke_capability(label, self.pending.when, params)
-                        self.pending_token = spec.get_token()
-                    except KeyError as e:
-                        logger.exception("Specified URL does not support '{}' capability.".format(label))
-
-                    if self.pending_token is None:
+                # capabilities are only retrieved at start and after errors
+                if self.stale and time.monotonic() >= self.next_poll:
+                    logger.info("Getting capabilities from {}".format(self.url))
+                    self.client.retrieve_capabilities(self.url)
+                    self.stale = False
+
+                if not self.paused and not self.stale and len(self.inflight) <= self.pipeline and len(self.queued) > 0:
+                    job = self.queued.popleft()
+                    invoked = self.invoke(job)
+                    if invoked is None:
                         logger.error("Could not acquire request token.")
-                        self.result_sink(self.name, None, self.pending.chunk_id)
-                        self.pending = None
-
-                    # wait some time
-                    time.sleep(2)
+                        self.result_sink(self.name, None, job.chunk_id)
+                    else:
+                        self.inflight.append(invoked)
+                        if len(self.inflight) == 1:
+                            self.advance()
 
-                elif self.pending_token is not None:
-                    try:
-                        self.client.retrieve_capabilities(self.url)
-                    except:
-                        logger.exception("URL '{}' is unreachable. Retrying in 5 seconds.".format(str(self.url)))
+                elif len(self.inflight) > 0 and time.monotonic() >= self.next_poll:
+                    # the probe measures staged jobs in order, so only the
+                    # oldest one can be complete
+                    job = self.inflight[0]
 
-                    # check results
-                    result = self.client.result_for(self.pending_token)
+                    # check results, unless already complete
+                    result = self.final if self.final is not None else self.client.result_for(job.token)
                     if isinstance(result, mplane.model.Exception):
                         # upon exception, add to queued again.
                         logger.error(result.__repr__())
                         #TODO: mplane doesn't like to forget exceptions??
-                        #self.client.forget(self.pending_token)
-                        self.queued.appendleft(self.pending)
-                        self.pending_token = None
-                        self.pending = None
+                        #self.client.forget(job.token)
+                        self.inflight.popleft()
+                        self.queued.appendleft(job._replace(token=None))
+                        self.fetched.pop(job.chunk_id, None)
+                        self.stale = True
+                        self.advance()
                     elif isinstance(result, mplane.model.Receipt):
-                        # still ongoing.. wait for a moment
-                        time.sleep(10)
+                        # still ongoing.. poll again later
+                        self.next_poll = time.monotonic() + self.schedule.next_delay()
                     elif isinstance(result, mplane.model.Result):
-                        # add to results
-                        self.client.forget(self.pending_token)
-                        result_list = list(result.schema_dict_iterator())
-                        self.result_sink(self.name, result_list, self.pending.chunk_id)
-                        logger.info("Result for chunk id: {} ({} result rows)".format(self.pending.chunk_id, len(result_list)))
-                        self.pending_token = None
-                        self.pending = None
+                        if self.final is None:
+                            self.final = result
+                            self.final_deadline = time.monotonic() + FETCH_WAIT
+                            self.schedule.finish()
+
+                        if self.fetch_token is not None and not self.fetch(job) and \
+                           time.monotonic() < self.final_deadline:
+                            # records taken by an outstanding fetch are not
+                            # in the result, so poll for it before passing
+                            # the result on
+                            self.next_poll = time.monotonic() + FETCH_SLEEP
+                        else:
+                            if self.fetch_token is not None:
+                                logger.error("Gave up waiting for the last fetch of chunk id: {}".format(job.chunk_id))
+
+                            # add to results
+                            self.client.forget(job.token)
+                            self.inflight.popleft()
+                            self.advance()
+                            result_list = self.fetched.pop(job.chunk_id, []) + list(result.schema_dict_iterator())
+                            self.result_sink(self.name, result_list, job.chunk_id)
+                            logger.info("Result for chunk id: {} ({} result rows)".format(job.chunk_id, len(result_list)))
                     else:
                         # other result, just print it out
                         logger.warn(str(result))
-                        time.sleep(10)
+                        self.next_poll = time.monotonic() + self.schedule.next_delay()
+
+                elif self.fetch_interval and self.final is None and len(self.inflight) > 0 and time.monotonic() >= self.next_fetch:
+                    done = self.fetch(self.inflight[0])
+                    self.next_fetch = time.monotonic() + (self.fetch_interval if done else FETCH_SLEEP)
             except Exception as e:
                 self.last_exception = e
                 logger.exception("Error handling ecn component.")
+                # back off while the probe is unreachable
+                self.stale = True
+                self.next_poll = time.monotonic() + self.schedule.next_delay()
             time.sleep(0.5)
 
     def add_job(self, addrs, chunk_id, ipv, flavor):
@@ -162,7 +313,6 @@ class EcnImp:
 class EcnAnalysis:
     def __init__(self, sites, compiled_chunk=None, ipv='ip4'):
         self.sites = sites
-        self.chunks = []
 
         columns = ['destination.'+ipv, 'destination.port'] + \
                   [site+':conn' for site in sites] + \
@@ -175,36 +325,28 @@ class EcnAnalysis:
         self.other = pd.DataFrame(columns=columns)
         self.incomplete = []
 
+        # set by EcnClient when not all sites have reported the chunk yet
+        self.provisional = False
+
         if compiled_chunk is not None:
             self._analyze(compiled_chunk, ipv)
 
     def get_ip_and_result(self):
-        for ip, result in self.offline.iterrows():
-            yield (ip, 'offline', result)
-
-        for ip, result in self.always_works.iterrows():
-            yield (ip, 'safe', result)
-
-        for ip, result in self.always_broken.iterrows():
-            yield (ip, 'broken_path', result)
-
-        for ip, result in self.works_per_site.iterrows():
-            yield (ip, 'broken_site', result)
-
-        for ip, result in self.other.iterrows():
-            yield (ip, 'broken_other', result)
+        for attr, status in CATEGORIES:
+            for ip, result in getattr(self, attr).iterrows():
+                yield (ip, status, result)
 
     def __add__(self, other):
+        """
+        Combine two analyses. This copies both; to combine the analyses of
+        many chunks, fold them into an :class:`EcnAggregate` instead.
+        """
         if not isinstance(other, EcnAnalysis):
             raise NotImplementedError("Only instances of Analysis can be added here.")
-        newa = EcnAnalysis(None, self.sites)
-
-        newa.chunks = self.chunks + other.chunks
-        newa.offline = self.offline.append(other.offline)
-        newa.always_works = self.always_works.append(other.always_works)
-        newa.always_broken = self.always_broken.append(other.always_broken)
-        newa.works_per_site = self.works_per_site.append(other.works_per_site)
-        newa.other = self.other.append(other.other)
+        newa = EcnAnalysis(self.sites)
+
+        for attr, _ in CATEGORIES:
+            setattr(newa, attr, pd.concat([getattr(self, attr), getattr(other, attr)]))
         newa.incomplete = self.incomplete + other.incomplete
 
         return newa
@@ -238,64 +380,91 @@ class EcnAnalysis:
         """
         return len(self.always_works) + len(self.always_broken) + len(self.works_per_site) + len(self.other)
 
-    def _merge_results(self, compiled_chunk, ipv):
+    def _site_results(self, site, chunk, ipv):
+        """
+        Reduce the records of one probe to a conn and a nego code per
+        target, indexed by target address.
 
-        merged_site_columns = {}
-        for site in self.sites:
-            merged_site_columns[site+":conn"] = RESULT_NOBODYHOME
-            merged_site_columns[site+":nego"] = RESULT_NOBODYHOME
+        :returns: a DataFrame with the columns destination.port, site:conn
+                  and site:nego, and a list of incomplete measurements.
+        """
+        ipcol = 'destination.'+ipv
+
+        # addresses as strings hash far faster than address objects
+        ips = chunk[ipcol].astype(str)
+
+        # a target needs exactly one record per ecnstate
+        ecnstate = pd.to_numeric(chunk['ecnspider.ecnstate'], errors='coerce')
+        counts = ips.map(ips.value_counts())
+        dups = pd.DataFrame({'ip': ips, 'ecnstate': ecnstate}).duplicated(keep=False)
+        complete = (counts == 2) & ~dups & ecnstate.isin([0, 1])
+
+        incomplete = [(site, ip, result) for ip, result in chunk[~complete].groupby(ips[~complete])]
+
+        records = chunk[complete].set_index(ips[complete])
+        on_mask = (ecnstate[complete] == 1).to_numpy()
+        ecn_off = records[~on_mask]
+        ecn_on = records[on_mask].reindex(ecn_off.index)
+
+        # after an early exit, the attempt with ECN was skipped or only
+        # probed briefly; failing, it leaves the target offline
+        conn_off = ecn_off['connectivity.ip'].fillna(False).astype(bool).to_numpy()
+        conn_on = ecn_on['connectivity.ip'].fillna(False).astype(bool).to_numpy()
+        conn = np.where(conn_off,
+                        np.where(conn_on, RESULT_WORKS, RESULT_BROKEN),
+                        np.where(conn_on, RESULT_OTHER, RESULT_NOBODYHOME))
+
+        # results evicted by the spider carry no flow data
+        synflags = pd.to_numeric(ecn_on['ecnspider.synflags.rev'], errors='coerce')
+        synflags = synflags.fillna(0).astype(np.int64).to_numpy()
+        nego = (synflags & SAEW) == SAE
+
+        result = pd.DataFrame({'destination.port': ecn_off['destination.port'].to_numpy(),
+                               site+':conn': conn,
+                               site+':nego': nego},
+                              index=ecn_off.index)
+        return result, incomplete
 
-        merged = {}
+    def _merge_results(self, compiled_chunk, ipv):
+        ipcol = 'destination.'+ipv
+
+        merged = None
         incomplete = []
         for site, chunk in compiled_chunk.items():
             if len(chunk) == 0:
                 print("analyzer: probe {} did not return any results".format(site))
                 continue
 
-            for ip_addr, result in chunk.groupby('destination.'+ipv):
-                ip = str(ip_addr)
-                if result.shape[0] != 2:
-                    incomplete.append((site, ip, result))
-                    continue
+            result, site_incomplete = self._site_results(site, chunk, ipv)
+            incomplete += site_incomplete
 
-                if result.iloc[0]['ecnspider.ecnstate'] == 1:
-                    ecn_on = result.iloc[0]
-                    ecn_off = result.iloc[1]
-                else:
-                    ecn_off = result.iloc[0]
-                    ecn_on = result.iloc[1]
+            if merged is None:
+                merged = result
+            else:
+                ports = merged['destination.port'].combine_first(result['destination.port'])
+                merged = merged.drop(columns='destination.port').join(
+                        result.drop(columns='destination.port'), how='outer')
+                merged['destination.port'] = ports
 
-                nego = (ecn_on['ecnspider.synflags.rev'] & SAEW) == SAE
+        if merged is None:
+            return pd.DataFrame(), incomplete
 
-                if ecn_off['connectivity.ip'] and ecn_on['connectivity.ip']:
-                    conn = RESULT_WORKS
-                elif ecn_off['connectivity.ip'] and not ecn_on['connectivity.ip']:
-                    conn = RESULT_BROKEN
-                elif not ecn_off['connectivity.ip'] and not ecn_on['connectivity.ip']:
-                    conn = RESULT_NOBODYHOME
-                else:
-                    conn = RESULT_OTHER
-
-                if ip not in merged:
-                    merged[ip] = merged_site_columns.copy()
-                    merged[ip]['destination.'+ipv] = ip
-                    merged[ip]['destination.port'] = ecn_off['destination.port']
-
-                merged[ip][site+':conn'] = conn
-                merged[ip][site+':nego'] = nego
-
-        #TODO: if a site does not contribute any results, the corresponding columns are missing.
-        #TODO: this happens only if the amount of IPs is very low.
+        # sites without a result for a target did not reach it
+        for site in self.sites:
+            for column in (site+':conn', site+':nego'):
+                if column not in merged:
+                    merged[column] = RESULT_NOBODYHOME
+        conn_columns = [site+':conn' for site in self.sites]
+        nego_columns = [site+':nego' for site in self.sites]
+        merged[conn_columns] = merged[conn_columns].fillna(RESULT_NOBODYHOME).astype(np.int64)
+        merged[nego_columns] = merged[nego_columns].fillna(False).astype(bool)
+        merged[ipcol] = merged.index
 
-        # convert to dataframe
-        merged = pd.DataFrame(merged).T
-        return merged, incomplete
+        return merged[[ipcol, 'destination.port'] + conn_columns + nego_columns], incomplete
 
     def _analyze(self, compiled_chunk, ipv='ip4'):
-        self.chunks.append(compiled_chunk)
-
         merged, self.incomplete = self._merge_results(compiled_chunk, ipv)
-        sites = pd.Series([str(key) for key in compiled_chunk.keys()])
+        sites = [str(key) for key in compiled_chunk.keys()]
 
         print("analyzer: number incomplete measurements: {}".format(len(self.incomplete)))
 
@@ -303,14 +472,15 @@ class EcnAnalysis:
             print("analyzer: no usable results in this chunk.")
             return
 
+        # conn codes as a (targets x sites) matrix, classified by reductions
+        conn = merged[[site+':conn' for site in sites]].to_numpy()
+
         # # # # # # # # # # # # # # # # # # # # # # # # #
         # offline: never made any successful connection #
-        mask_offline = merged[sites+':conn'].apply(lambda x: x == RESULT_NOBODYHOME, reduce=False).all(axis=1)
-        df_online = merged[-mask_offline]
+        mask_offline = (conn == RESULT_NOBODYHOME).all(axis=1)
         self.offline = merged[mask_offline]
 
-        num_offline = (mask_offline.sum())
-        num_online = (-mask_offline).sum()
+        num_online = len(merged) - mask_offline.sum()
         print("analyzer: online: {} ({:.2%})".format(num_online, num_online/len(merged)))
 
         if num_online == 0:
@@ -319,53 +489,183 @@ class EcnAnalysis:
 
         # # # # # # # # # # # # # # # # # # # # #
         # always works without ECN and with ECN #
-        mask_works = df_online[sites+':conn'].apply(lambda x: x == RESULT_WORKS, reduce=False).all(axis=1)
-        self.always_works = df_online[mask_works]
+        mask_works = ~mask_offline & (conn == RESULT_WORKS).all(axis=1)
+        self.always_works = merged[mask_works]
         num_works = mask_works.sum()
 
         print("analyzer: works all path: {} ({:.3%})".format(num_works, num_works/num_online))
 
-        # gather the rest
-        df_works_not = df_online[np.logical_not(mask_works)]
-
         # # # # # # # # # # # # # # # # # # # # # # # #
         # always works without ECN but never with ECN #
-        mask_totally_broken = df_works_not[sites+':conn'].apply(lambda x: x == RESULT_BROKEN, reduce=False).all(axis=1)
-        self.always_broken = df_works_not[mask_totally_broken]
+        rest = ~mask_offline & ~mask_works
+        mask_totally_broken = rest & (conn == RESULT_BROKEN).all(axis=1)
+        self.always_broken = merged[mask_totally_broken]
         num_totally_broken = mask_totally_broken.sum()
 
         print("analyzer: always works without ECN but never with ECN: {} ({:.3%})".format(num_totally_broken, num_totally_broken/num_online))
 
-        # gather the rest
-        df_totally_broken_not = df_works_not[np.logical_not(mask_totally_broken)]
-
         # # # # # # # # # # # # # # # # # # # # # # # # # #
         # either works with and without ECN or not at all #
-        mask_works_per_site = df_totally_broken_not[sites+':conn'].apply(lambda x: (x == RESULT_WORKS) | (x == RESULT_NOBODYHOME), reduce=False).all(axis=1)
-        self.works_per_site = df_totally_broken_not[mask_works_per_site]
+        rest &= ~mask_totally_broken
+        mask_works_per_site = rest & ((conn == RESULT_WORKS) | (conn == RESULT_NOBODYHOME)).all(axis=1)
+        self.works_per_site = merged[mask_works_per_site]
         num_works_per_site = mask_works_per_site.sum()
         print("analyzer: either works with and without ECN or not at all: {} ({:.3%})".format(num_works_per_site, num_works_per_site/num_online))
 
         # gather the rest
-        num_works_per_site_not = (np.logical_not(mask_works_per_site)).sum()
-        self.other = df_totally_broken_not[np.logical_not(mask_works_per_site)]
+        rest &= ~mask_works_per_site
+        num_works_per_site_not = rest.sum()
+        self.other = merged[rest]
 
         print("analyzer: transient/other: {} ({:.3%})".format(num_works_per_site_not, num_works_per_site_not/num_online))
 
+class EcnAggregate:
+    """
+    Statistics over all chunks of a campaign.
+
+    The analysis of each chunk is folded in with :meth:`add` as it arrives
+    and can be dropped afterwards: only a counter per category and, per
+    target, its packed address and a category code are kept. A target
+    which is measured in several chunks is counted once per chunk.
+
+    Analyses added under the same key replace each other, so that the
+    provisional analysis of a chunk is superseded when it is refined.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.incomplete = 0
+
+        # key -> (counts, incomplete, ipver, ips, codes)
+        self.segments = collections.OrderedDict()
+
+    @property
+    def chunks(self):
+        return len(self.segments)
+
+    def add(self, analysis, key=None):
+        ipver = array('B')
+        ips = bytearray()
+        codes = array('B')
+        for code, (attr, _) in enumerate(CATEGORIES):
+            frame = getattr(analysis, attr)
+            for ip in frame.index:
+                ip = ip_address(ip)
+                ipver.append(ip.version)
+                ips += ip.packed.ljust(IP_SLOT, b'\0')
+            codes.extend([code] * len(frame))
+
+        counts = collections.Counter({attr: len(getattr(analysis, attr)) for attr, _ in CATEGORIES})
+        incomplete = len(analysis.incomplete)
+
+        with self.lock:
+            if key is None:
+                key = object()
+            replaced = self.segments.pop(key, None)
+            if replaced is not None:
+                self.counts.subtract(replaced[0])
+                self.incomplete -= replaced[1]
+
+            self.counts.update(counts)
+            self.incomplete += incomplete
+            self.segments[key] = (counts, incomplete, ipver, ips, codes)
+
+    def get_ip_and_status(self):
+        """Yield the address and status of each classified target."""
+        with self.lock:
+            segments = list(self.segments.values())
+
+        for _, _, ipver, ips, codes in segments:
+            for i in range(len(codes)):
+                start = i * IP_SLOT
+                length = 4 if ipver[i] == 4 else 16
+                yield (ip_address(bytes(ips[start:start+length])),
+                       CATEGORIES[codes[i]][1])
+
+    def to_json(self):
+        return {'offline': self.counts['offline'],
+                'online': len(self),
+                'always_works': self.counts['always_works'],
+                'always_broken': self.counts['always_broken'],
+                'works_per_site': self.counts['works_per_site'],
+                'other': self.counts['other'],
+                'incomplete': self.incomplete,
+                'chunks': self.chunks}
+
+    def dump(self):
+        num_online = len(self)
+        num_total = num_online + self.counts['offline']
+        print("chunks: {}, online: {} ({:.2%})".format(self.chunks, num_online, num_online/num_total if num_total > 0 else 0))
+
+        if num_online == 0:
+            return
+
+        print("analyzer: works all path: {} ({:.3%})".format(self.counts['always_works'], self.counts['always_works']/num_online))
+
+        print("analyzer: always works without ECN but never with ECN: {} ({:.3%})".format(self.counts['always_broken'], self.counts['always_broken']/num_online))
+
+        print("analyzer: either works with and without ECN or not at all: {} ({:.3%})".format(self.counts['works_per_site'], self.counts['works_per_site']/num_online))
+
+        print("analyzer: transient/other: {} ({:.3%})".format(self.counts['other'], self.counts['other']/num_online))
+
+    def __len__(self):
+        """
+        :return: the number of successful measurements
+        """
+        return sum(self.counts[attr] for attr, _ in CATEGORIES[1:])
+
 class EcnClient:
-    def __init__(self, result_sink, tls_state, probes, ipv='ip4'):
+    """
+    Distributes chunks to all probes and analyses the results of a chunk
+    once every probe has returned them.
+
+    With ``quorum`` (a number of probes) or ``deadline`` (seconds since
+    the first probe returned the chunk), a chunk is analysed as soon as
+    enough probes have returned it or the deadline has passed. That
+    analysis is passed to the result sink with ``provisional`` set, and
+    is refined each time a late probe returns the chunk, until the
+    analysis over all probes is final.
+
+    Until a probe returns a chunk, the records fetched from the probes
+    while it is being measured (see :class:`EcnImp`) are analysed for
+    the targets every probe has records for. That analysis is passed to
+    ``partial_sink`` with ``provisional`` set, and is superseded in the
+    aggregate by the analysis of the chunk.
+    """
+
+    def __init__(self, result_sink, tls_state, probes, ipv='ip4', quorum=None, deadline=None, pipeline=0,
+                 partial_sink=None, fetch_interval=FETCH_INTERVAL):
         self.ipv = ipv
-        self.imps = [EcnImp(name, tls_state, url, self.imp_sink) for name, url in probes]
+        self.imps = [EcnImp(name, tls_state, url, self.imp_sink, pipeline=pipeline,
+                            partial_sink=self.imp_partial_sink, fetch_interval=fetch_interval) for name, url in probes]
         self.sites = [name for name, url in probes]
 
+        self.quorum = len(self.sites) if quorum is None else min(quorum, len(self.sites))
+        self.deadline = deadline
+
         self.imps_results_lock = threading.RLock()
         self.imps_results = {name: {} for name, _ in probes}
 
+        # chunk id -> time the first probe returned it, and the number of
+        # probes covered by its provisional analysis
+        self.first_report = {}
+        self.provisional = {}
+
+        # chunk id -> probe -> records fetched so far, and the chunks with
+        # records fetched since their last analysis
+        self.partials = {}
+        self.partials_changed = set()
+
         self.result_sink = result_sink
+        self.partial_sink = partial_sink
 
         self.running = True
         self.wait_final_analysis = False
 
+        # campaign statistics, updated as chunks are analysed
+        self.aggregate = EcnAggregate()
+
         self.thread = threading.Thread(target=self.analyzer_func, daemon=True, name="ecnclient")
         self.thread.start()
 
@@ -398,40 +698,124 @@ class EcnClient:
     def imp_sink(self, name, result, chunk_id):
         with self.imps_results_lock:
             self.imps_results[name][chunk_id] = result
+            self.first_report.setdefault(chunk_id, time.monotonic())
+
+            # the result holds the fetched records as well
+            self.partials.pop(chunk_id, None)
+            self.partials_changed.discard(chunk_id)
+
+    def imp_partial_sink(self, name, rows, chunk_id):
+        with self.imps_results_lock:
+            if chunk_id in self.first_report:
+                return
+            self.partials.setdefault(chunk_id, {}).setdefault(name, []).extend(rows)
+            self.partials_changed.add(chunk_id)
+
+    def analyze_partials(self):
+        """
+        Analyse the records fetched for chunks no probe has returned yet,
+        for the targets every probe has records for.
+        """
+        ipcol = 'destination.'+self.ipv
+
+        with self.imps_results_lock:
+            compiled_chunks = {}
+            for chunk_id in self.partials_changed:
+                compiled_chunks[chunk_id] = {name: pd.DataFrame(rows) for name, rows in self.partials[chunk_id].items()}
+            self.partials_changed.clear()
+
+        for chunk_id, compiled_chunk in compiled_chunks.items():
+            if len(compiled_chunk) < len(self.imps):
+                continue
+
+            ips = None
+            for chunk in compiled_chunk.values():
+                chunk_ips = set(chunk[ipcol].astype(str))
+                ips = chunk_ips if ips is None else ips & chunk_ips
+            if len(ips) == 0:
+                continue
+
+            compiled_chunk = {name: chunk[chunk[ipcol].astype(str).isin(ips)]
+                              for name, chunk in compiled_chunk.items()}
+            analysis = EcnAnalysis(sites=self.sites, compiled_chunk=compiled_chunk, ipv=self.ipv)
+            analysis.provisional = True
+
+            with self.imps_results_lock:
+                if chunk_id in self.first_report:
+                    # superseded by a probe result in the meantime
+                    continue
+                self.aggregate.add(analysis, chunk_id)
+
+            if self.partial_sink is not None:
+                self.partial_sink(analysis, chunk_id)
+
+    def chunks_to_analyze(self):
+        """
+        Determine the chunks which have been completed by all probes, and
+        the chunks which are due for a provisional analysis.
+
+        :returns: a list of (chunk_id, final) tuples
+        """
+        logger = logging.getLogger('ecnclient')
+        now = time.monotonic()
+
+        due = []
+        with self.imps_results_lock:
+            reported = collections.Counter()
+            for name, results in self.imps_results.items():
+                if len(results) > 0:
+                    logger.debug("{} finished chunks: {}".format(name, ",".join([str(chunk_id) for chunk_id in results.keys()])))
+                reported.update(results.keys())
+
+            for chunk_id, count in reported.items():
+                if count == len(self.imps):
+                    due.append((chunk_id, True))
+                elif count > self.provisional.get(chunk_id, 0) and \
+                     (count >= self.quorum or
+                      (self.deadline is not None and now - self.first_report[chunk_id] >= self.deadline)):
+                    due.append((chunk_id, False))
+
+        return due
 
     def analyzer_func(self):
         logger = logging.getLogger('ecnclient')
         logger.info("Analyzer started.")
 
         while self.running:
-            # determine chunks which have been completed by all probes
-            chunks_finished = None
-            with self.imps_results_lock:
-                for name, results in self.imps_results.items():
-                    if len(results) > 0:
-                        logger.debug("{} finished chunks: {}".format(name, ",".join([str(chunk_id) for chunk_id in results.keys()])))
+            self.analyze_partials()
+            due = self.chunks_to_analyze()
 
-                    if chunks_finished is None:
-                        chunks_finished = set(results.keys())
-                    else:
-                        chunks_finished &= set(results.keys())
-
-            if len(chunks_finished) == 0:
-                time.sleep(1)
+            if len(due) == 0:
+                time.sleep(ANALYZER_SLEEP)
                 self.wait_final_analysis = False
                 continue
 
-            logger.info("Measurement for chunks {} now completed by all probes.".format(",".join([str(chunk_id) for chunk_id in chunks_finished])))
-
-            for chunk_id in chunks_finished:
-                # pop chunks finished by all probes from imp results pool
+            for chunk_id, final in due:
+                # pop chunks finished by all probes from imp results pool,
+                # keep the results of the others for refinement
                 compiled_chunk = {}
                 with self.imps_results_lock:
                     for name, results in self.imps_results.items():
-                        compiled_chunk[name] = pd.DataFrame(results.pop(chunk_id))
+                        if chunk_id in results:
+                            result = results.pop(chunk_id) if final else results[chunk_id]
+                            compiled_chunk[name] = pd.DataFrame(result)
+
+                    if final:
+                        del self.first_report[chunk_id]
+                        self.provisional.pop(chunk_id, None)
+                    else:
+                        self.provisional[chunk_id] = len(compiled_chunk)
+
+                if final:
+                    logger.info("Measurement for chunk {} now completed by all probes.".format(chunk_id))
+                    analysis = EcnAnalysis(sites=self.sites, compiled_chunk=compiled_chunk, ipv=self.ipv)
+                else:
+                    logger.info("Measurement for chunk {} completed by {} of {} probes, analysing provisionally.".format(
+                                chunk_id, len(compiled_chunk), len(self.imps)))
+                    analysis = EcnAnalysis(sites=list(compiled_chunk), compiled_chunk=compiled_chunk, ipv=self.ipv)
+                    analysis.provisional = True
 
-                logger.debug("processing chunk {}".format(chunk_id))
-                analysis = EcnAnalysis(sites=self.sites, compiled_chunk=compiled_chunk, ipv=self.ipv)
+                self.aggregate.add(analysis, chunk_id)
                 logger.debug("calling result_sink() with result of chunk {}...".format(chunk_id))
                 self.result_sink(analysis, chunk_id)
                 logger.debug("result_sink() returned.")
@@ -452,6 +836,8 @@ class EcnClient:
                 'queued': [job.chunk_id for job in imp.queued],
                 'finished': finished,
                 'pending': imp.pending[0] if imp.pending is not None else None,
+                'staged': [job.chunk_id for job in list(imp.inflight)[1:]],
+                'fetched': {chunk_id: len(rows) for chunk_id, rows in list(imp.fetched.items())},
                 'running': imp.running,
                 'paused': imp.paused,
                 'last_exception': repr(imp.last_exception) if imp.last_exception is not None else None
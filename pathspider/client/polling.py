@@ -0,0 +1,71 @@
+import random
+import time
+
+# seconds to the first poll without an estimate, and after the expected
+# completion of a measurement; doubled up to POLL_CEILING on each poll
+POLL_FLOOR = 1
+POLL_CEILING = 60
+POLL_BACKOFF = 2
+
+# fraction by which poll delays are spread randomly, so that imps started
+# together do not poll their probes in lockstep
+POLL_JITTER = 0.2
+
+# weight of the latest measurement in the estimate of the time per target
+POLL_SMOOTHING = 0.3
+
+class PollSchedule:
+    """
+    Decides when to poll a probe for the result of a measurement.
+
+    The time per target is estimated from the measurements completed so
+    far. The first poll of a measurement is due when it is expected to
+    complete; from then on, or while there is no estimate yet, polls back
+    off exponentially from POLL_FLOOR.
+    """
+
+    def __init__(self, floor=POLL_FLOOR, ceiling=POLL_CEILING, backoff=POLL_BACKOFF, jitter=POLL_JITTER):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.backoff = backoff
+        self.jitter = jitter
+
+        self.per_target = None
+        self.started = None
+        self.size = 0
+        self.polls = 0
+
+    def start(self, size):
+        """Note that the probe started measuring size targets."""
+        self.started = time.monotonic()
+        self.size = max(size, 1)
+        self.polls = 0
+
+    def finish(self):
+        """Note that the result of the measurement was picked up."""
+        if self.started is None:
+            return
+        sample = (time.monotonic() - self.started) / self.size
+        if self.per_target is None:
+            self.per_target = sample
+        else:
+            self.per_target += POLL_SMOOTHING * (sample - self.per_target)
+        self.started = None
+
+    def expected(self):
+        """Return when the measurement is expected to complete, or None."""
+        if self.started is None or self.per_target is None:
+            return None
+        return self.started + self.per_target * self.size
+
+    def next_delay(self):
+        """Return the seconds to wait before the next poll."""
+        expected = self.expected()
+        remaining = expected - time.monotonic() if expected is not None else 0
+        if remaining > self.floor:
+            delay = min(remaining, self.ceiling)
+        else:
+            delay = min(self.floor * self.backoff ** self.polls, self.ceiling)
+            self.polls += 1
+
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
@@ -7,6 +7,8 @@ import time
 import pandas as pd
 from ipaddress import ip_address
 
+from .polling import PollSchedule
+
 TbJob = collections.namedtuple('TbJob', ['ip', 'port', 'ipv', 'probe', 'when'])
 
 def str_or_none(obj):
@@ -23,6 +25,12 @@ class TbImp:
         self.pending = None
         self.result_sink = result_sink
 
+        # when to poll for the pending result, and whether the capabilities
+        # of the probe have to be retrieved (again)
+        self.schedule = PollSchedule()
+        self.next_poll = 0
+        self.stale = True
+
         self.paused = False
         self.running = True
 
@@ -59,12 +67,16 @@ class TbImp:
 
     def worker(self):
         logger = logging.getLogger('tbclient.imp-'+self.name)
-        logger.info("Getting capabilities from {}".format(self.url))
-        self.client.retrieve_capabilities(self.url)
         logger.info("Started.")
         while self.running:
             try:
-                if not self.paused and self.pending_token is None and len(self.queued) > 0:
+                # capabilities are only retrieved at start and after errors
+                if self.stale and time.monotonic() >= self.next_poll:
+                    logger.info("Getting capabilities from {}".format(self.url))
+                    self.client.retrieve_capabilities(self.url)
+                    self.stale = False
+
+                if not self.paused and not self.stale and self.pending_token is None and len(self.queued) > 0:
                     logger.info("Sending tracebox request.")
                     self.pending = self.queued.popleft()
                     label = 'scamper-tracebox-specific-'+self.pending.ipv
@@ -74,19 +86,18 @@ class TbImp:
                         self.pending_token = spec.get_token()
                     except KeyError:
                         logger.exception("Specified URL does not support '{}' capability.".format(label))
+                        self.stale = True
 
                     if self.pending_token is None:
                         logger.exception("Could not acquire request token.")
                         self.result_sink(self.name, None, self.pending.ip)
                         self.pending = None
+                    else:
+                        self.schedule.start(1)
+                        self.next_poll = time.monotonic() + self.schedule.next_delay()
 
                     continue
-                elif self.pending_token is not None:
-                    try:
-                        self.client.retrieve_capabilities(self.url)
-                    except:
-                        logger.exception("URL '{}' unreachable. Retrying in 5 seconds".format(str(self.url)))
-
+                elif self.pending_token is not None and time.monotonic() >= self.next_poll:
                     # check results
                     result = self.client.result_for(self.pending_token)
                     if isinstance(result, mplane.model.Exception):
@@ -96,13 +107,15 @@ class TbImp:
                         self.queued.append(self.pending)
                         self.pending_token = None
                         self.pending = None
+                        self.stale = True
                     elif isinstance(result, mplane.model.Receipt):
-                        # still ongoing.. wait for a moment
-                        time.sleep(10)
+                        # still ongoing.. poll again later
+                        self.next_poll = time.monotonic() + self.schedule.next_delay()
                     elif isinstance(result, mplane.model.Result):
                         logger.info("Got trace for IP {}.".format(self.pending.ip))
                         # add to results
                         self.client.forget(self.pending_token)
+                        self.schedule.finish()
                         result_list = list(result.schema_dict_iterator())
                         self.result_sink(self.name, result_list, self.pending.ip)
                         self.pending_token = None
@@ -110,10 +123,13 @@ class TbImp:
                     else:
                         # other result, just print it out
                         logger.warn(result)
-                        time.sleep(10)
+                        self.next_poll = time.monotonic() + self.schedule.next_delay()
             except Exception as e:
                 self.last_exception = e
                 logger.exception("Error handling tracebox component.")
+                # back off while the probe is unreachable
+                self.stale = True
+                self.next_poll = time.monotonic() + self.schedule.next_delay()
             time.sleep(0.5)
 
     def add_job(self, ip, port, mode='tcp'):
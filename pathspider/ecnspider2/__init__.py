@@ -27,7 +27,11 @@ from ipaddress import ip_address
 import mplane
 from . import qofspider
 from . import ecnspider
+from . import recordstore
+from . import journal
+from .resident import ResidentSpider
 import collections
+import atexit
 
 import os.path
 import time
@@ -41,6 +45,9 @@ ipfix.ie.use_5103_default()
 scriptdir = os.path.dirname(os.path.abspath(__file__))
 ipfix.ie.use_specfile(os.path.join(scriptdir, "qof.iespec"))
 
+# seconds between checks for interruption of a queued measurement
+RUN_QUEUE_POLL = 1
+
 def strbool(s):
     """
     interpret given parameter to a boolean value.
@@ -57,9 +64,64 @@ def strbool(s):
     else:
         return False
 
+class RunQueue:
+    """
+    Lets one measurement run at a time. Up to ``depth`` further
+    measurements wait for their turn and run in the order they arrived, so
+    that a client can stage its next chunk; any beyond are refused.
+    """
+
+    def __init__(self, depth=0):
+        self.depth = depth
+        self.cond = threading.Condition()
+        self.waiting = collections.deque()
+        self.running = False
+
+    def acquire(self, check_interrupt=None):
+        """
+        Wait for the turn of a measurement.
+
+        :returns: True once the measurement may run, False if it was refused
+                  or interrupted while waiting.
+        """
+        with self.cond:
+            if not self.running and len(self.waiting) == 0:
+                self.running = True
+                return True
+            if len(self.waiting) >= self.depth:
+                return False
+
+            ticket = object()
+            self.waiting.append(ticket)
+            try:
+                while self.running or self.waiting[0] is not ticket:
+                    if check_interrupt is not None and check_interrupt():
+                        return False
+                    self.cond.wait(RUN_QUEUE_POLL)
+                self.running = True
+                return True
+            finally:
+                self.waiting.remove(ticket)
+                self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.waiting)
+
 def services(ip4addr=None, ip6addr=None, worker_count=None,
         connection_timeout=None, interface_uri=None, qof_port=54739,
-        enable_ipv6=True):
+        enable_ipv6=True, engine='thread', engine_threads=None,
+        scheduler='semaphore', phase_batch=None, phase_deadline=None,
+        sysctl_method='exec', ecn_mode='sysctl', ecn_cc=None,
+        table_ttl=None, table_size=None, resident=False, collector='dict',
+        local_sources=None, bind_sources=None, port_range=None,
+        port_quarantine=None, adaptive_timeout=None, timeout_floor=None,
+        early_exit=None, probe_timeout=None, http_probe=None,
+        journal_dir=None, run_queue=1, proc_helper=None):
     """
     Return a list of mplane.scheduler.Service instances implementing
     the mPlane capabilities for ecnspider.
@@ -69,15 +131,78 @@ def services(ip4addr=None, ip6addr=None, worker_count=None,
     if connection_timeout is None:
         connection_timeout = 15
 
-    # global lock, only one ecnspider instance may run at a time.
-    lock = threading.Lock()
+    # tuning options passed through to the spider
+    spider_args = {'engine': engine}
+    if engine_threads is not None:
+        spider_args['engine_threads'] = int(engine_threads)
+    spider_args['scheduler'] = scheduler
+    if phase_batch is not None:
+        spider_args['phase_batch'] = int(phase_batch)
+    if phase_deadline is not None:
+        spider_args['phase_deadline'] = float(phase_deadline)
+    spider_args['sysctl_method'] = sysctl_method
+    if proc_helper is not None:
+        spider_args['proc_helper'] = proc_helper
+    spider_args['ecn_mode'] = ecn_mode
+    if ecn_cc is not None:
+        spider_args['ecn_cc'] = ecn_cc
+    if table_ttl is not None:
+        spider_args['table_ttl'] = float(table_ttl)
+    if table_size is not None:
+        spider_args['table_size'] = int(table_size)
+    spider_args['collector'] = collector
+    if local_sources is not None:
+        spider_args['local_sources'] = [source.strip() for source in local_sources.split(",")]
+    if bind_sources is not None:
+        spider_args['bind_sources'] = [source.strip() for source in bind_sources.split(",")]
+    if port_range is not None:
+        spider_args['port_range'] = tuple(int(port) for port in port_range.split("-"))
+    if port_quarantine is not None:
+        spider_args['port_quarantine'] = float(port_quarantine)
+    if adaptive_timeout is not None:
+        spider_args['adaptive_timeout'] = adaptive_timeout
+    if timeout_floor is not None:
+        spider_args['timeout_floor'] = float(timeout_floor)
+    if early_exit is not None:
+        spider_args['early_exit'] = early_exit
+    if probe_timeout is not None:
+        spider_args['probe_timeout'] = float(probe_timeout)
+
+    if journal_dir is not None:
+        os.makedirs(journal_dir, exist_ok=True)
+
+    # global lock, only one ecnspider instance may run at a time; further
+    # measurements are queued behind it.
+    lock = RunQueue(int(run_queue))
+
+    # records of running measurements, by specification token
+    streams = {}
+
+    # one spider kept running for all measurements, if enabled
+    if strbool(resident):
+        resident = ResidentSpider(ip4addr, ip6addr)
+        # do not leave the spider's QoF running when the service exits
+        atexit.register(resident.shutdown)
+    else:
+        resident = None
+
+    service_args = dict(worker_count=worker_count, connection_timeout=connection_timeout, interface_uri=interface_uri, qof_port=qof_port, singleton_lock=lock, streams=streams, resident=resident, journal_dir=journal_dir)
+
+    # options of the http spider only
+    http_args = dict(spider_args)
+    if http_probe is not None:
+        http_args['http_probe'] = http_probe
 
     servicelist = []
-    servicelist.append(EcnspiderService(ecnspider_cap(4), worker_count=worker_count, connection_timeout=connection_timeout, interface_uri=interface_uri, qof_port=qof_port, ip4addr=ip4addr, singleton_lock=lock))
-    servicelist.append(EcnspiderHttpService(ecnspider_http_cap(4), worker_count=worker_count, connection_timeout=connection_timeout, interface_uri=interface_uri, qof_port=qof_port, ip4addr=ip4addr, singleton_lock=lock))
+    servicelist.append(EcnspiderService(ecnspider_cap(4), ip4addr=ip4addr, spider_args=spider_args, **service_args))
+    servicelist.append(EcnspiderHttpService(ecnspider_http_cap(4), ip4addr=ip4addr, spider_args=http_args, **service_args))
+    servicelist.append(EcnspiderHttpsService(ecnspider_https_cap(4), ip4addr=ip4addr, spider_args=spider_args, **service_args))
+    servicelist.append(EcnspiderFetchService(ecnspider_fetch_cap(4), streams))
     if strbool(enable_ipv6):
-        servicelist.append(EcnspiderService(ecnspider_cap(6), worker_count=worker_count, connection_timeout=connection_timeout, interface_uri=interface_uri, qof_port=qof_port, ip6addr=ip6addr, singleton_lock=lock))
-        servicelist.append(EcnspiderHttpService(ecnspider_http_cap(6), worker_count=worker_count, connection_timeout=connection_timeout, interface_uri=interface_uri, qof_port=qof_port, ip4addr=ip4addr, singleton_lock=lock))
+        servicelist.append(EcnspiderService(ecnspider_cap(6), ip6addr=ip6addr, spider_args=spider_args, **service_args))
+        servicelist.append(EcnspiderHttpService(ecnspider_http_cap(6), ip4addr=ip4addr, spider_args=http_args, **service_args))
+        servicelist.append(EcnspiderHttpsService(ecnspider_https_cap(6), ip6addr=ip6addr, spider_args=spider_args, **service_args))
+        servicelist.append(EcnspiderFetchService(ecnspider_fetch_cap(6), streams))
 
     return servicelist
 
@@ -101,11 +226,62 @@ def ecnspider_cap(ip_version):
     cap.add_result_column("ecnspider.synflags.rev")
     cap.add_result_column("ecnspider.unionflags.rev")
     cap.add_result_column("ecnspider.ttl.rev.min")
+    cap.add_result_column("ecnspider.early")
 
     return cap
 
-class EcnspiderService(mplane.scheduler.Service):
-    def __init__(self, cap, worker_count, connection_timeout, interface_uri, qof_port, singleton_lock, ip4addr=None, ip6addr=None):
+# MergedRecord field exported in each result column
+RESULT_FIELDS = {
+    "source.port": "port",
+    "destination.ip4": "ip",
+    "destination.ip6": "ip",
+    "destination.port": "rport",
+    "ecnspider.hostname": "host",
+    "connectivity.ip": "connstate",
+    "ecnspider.httpstatus": "httpstatus",
+    "ecnspider.ecnstate": "ecnstate",
+    "ecnspider.initflags.fwd": "fif",
+    "ecnspider.synflags.fwd": "fsf",
+    "ecnspider.unionflags.fwd": "fuf",
+    "ecnspider.initflags.rev": "fir",
+    "ecnspider.synflags.rev": "fsr",
+    "ecnspider.unionflags.rev": "fur",
+    "ecnspider.ttl.rev.min": "ttl",
+    "ecnspider.early": "early",
+    "ecnspider.tls.handshake": "tls",
+}
+
+def export_records(res, records):
+    """
+    Fill the result columns of res with the given MergedRecords.
+    """
+    columns = [(name, RESULT_FIELDS[name]) for name in res.result_column_names()]
+    for i, record in enumerate(records):
+        for name, field in columns:
+            res.set_result_value(name, getattr(record, field), i)
+
+class EcnspiderServiceBase(mplane.scheduler.Service):
+    """
+    Common part of the ecnspider services: runs a spider over the targets
+    in the specification and returns the merged records.
+
+    While a measurement runs, its records are registered in ``streams``
+    under the specification's token, where an :class:`EcnspiderFetchService`
+    can take them as they are merged. The final result then only holds the
+    records which were not fetched yet.
+
+    If a :class:`ResidentSpider` is given, the jobs are run on its spider
+    instead of on one started for this measurement.
+
+    If ``journal_dir`` is given, records are also written to a journal
+    there as they are merged (see :class:`journal.Journal`). A measurement
+    which is interrupted or fails keeps its journal, and the same
+    measurement invoked again only measures the targets not completed yet.
+    """
+
+    spider_class = None
+
+    def __init__(self, cap, worker_count, connection_timeout, interface_uri, qof_port, singleton_lock, ip4addr=None, ip6addr=None, spider_args=None, streams=None, resident=None, journal_dir=None):
         super().__init__(cap)
 
         self.worker_count = int(worker_count)
@@ -115,71 +291,105 @@ class EcnspiderService(mplane.scheduler.Service):
         self.ip4addr = ip4addr
         self.ip6addr = ip6addr
         self.singleton_lock = singleton_lock
+        self.spider_args = spider_args or {}
+        self.streams = streams if streams is not None else {}
+        self.resident = resident
+        self.journal_dir = journal_dir
+
+    def make_jobs(self, spec, ips):
+        """
+        Return an iterable of jobs for the targets in spec; it is consumed
+        lazily by the spider.
+        """
+        raise NotImplementedError("Cannot instantiate an abstract EcnspiderServiceBase")
 
     def run(self, spec, check_interrupt):
-        # try to acquire lock or immediately return error
-        if not self.singleton_lock.acquire(blocking=False):
-            raise Exception("An instance of ecnspider is already running.")
-
+        # wait for our turn, or return error if too many are queued
+        if not self.singleton_lock.acquire(check_interrupt):
+            if check_interrupt is not None and check_interrupt():
+                raise Exception("Interrupted while waiting for the running instance of ecnspider.")
+            raise Exception("An instance of ecnspider is already running, and {} are queued.".format(len(self.singleton_lock)))
+
+        token = spec.get_token()
+        jnl = None
         try:
             # wrap the spec in a job source, either ipv4 or ipv6
             if spec.has_parameter("destination.ip4"):
                 ips = spec.get_parameter_value("destination.ip4")
-                ipv = "ip4"
             else:
                 ips = spec.get_parameter_value("destination.ip6")
-                ipv = "ip6"
 
-            # setup ecnspider
-            result_sink = collections.deque()
-            ecn = ecnspider.EcnSpider2(result_sink.append,
+            result_sink = recordstore.RecordStore()
+            spider_kwargs = dict(self.spider_args,
                     worker_count=self.worker_count,
                     conn_timeout=self.connection_timeout,
-                    interface_uri=self.interface_uri, local_ip4=self.ip4addr,
-                    local_ip6=self.ip6addr, qof_port=self.qof_port,
-                    check_interrupt=check_interrupt)
-
-            # formulate jobs
-            ports = spec.get_parameter_value("destination.port")
-            if len(ports) != len(ips):
-                raise ValueError("destination.ip4/6, destination.port and torrentspider.nodeid don't have same amount of elements.")
-
-            jobs = [ecnspider.Job(ip_address(ip), ip, port, None) for ip, port in zip(ips, ports)]
-            for job in jobs:
-                ecn.add_job(job)
-
-            # run measurement
-            starttime = datetime.utcnow()
-            ecn.run()
-            ecn.stop()
-            if ecn.exception is not None:
-                raise ecn.exception
-            stoptime = datetime.utcnow()
+                    interface_uri=self.interface_uri, qof_port=self.qof_port)
+            jobs = self.make_jobs(spec, ips)
+            self.streams[token] = result_sink
+
+            # records go to the store through the journal, if there is one
+            sink = result_sink
+            if self.journal_dir is not None:
+                jnl = journal.Journal(os.path.join(self.journal_dir, journal.journal_name(spec)), result_sink)
+                jnl.load()
+                jobs = jnl.pending(jobs)
+                sink = jnl
+
+            if self.resident is not None:
+                # hand the jobs to the spider which is already running
+                starttime = datetime.utcnow()
+                self.resident.run_chunk(self.spider_class, spider_kwargs,
+                                        jobs, sink, check_interrupt)
+                stoptime = datetime.utcnow()
+            else:
+                # setup ecnspider
+                ecn = self.spider_class(sink.append,
+                        local_ip4=self.ip4addr, local_ip6=self.ip6addr,
+                        check_interrupt=check_interrupt, **spider_kwargs)
+
+                ecn.add_jobs(jobs)
+
+                # run measurement
+                starttime = datetime.utcnow()
+                ecn.run()
+                ecn.stop()
+                if ecn.exception is not None:
+                    raise ecn.exception
+                stoptime = datetime.utcnow()
+
+            # an interrupted measurement may be resumed later
+            if jnl is not None:
+                jnl.close(remove=(check_interrupt is None or not check_interrupt()))
+
+            # whatever has not been fetched yet goes into the result
+            self.streams.pop(token, None)
+            records = result_sink.take()
 
             res = mplane.model.Result(specification=spec)
             res.set_when(mplane.model.When(a=starttime, b=stoptime))
+            export_records(res, records)
 
-            for i, result in enumerate(result_sink):
-                 res.set_result_value("source.port", result.port, i)
-                 res.set_result_value("destination."+ipv, result.ip, i)
-                 res.set_result_value("destination.port", result.rport, i)
-                 res.set_result_value("connectivity.ip", result.connstate, i)
-                 res.set_result_value("ecnspider.ecnstate", result.ecnstate, i)
-                 res.set_result_value("ecnspider.initflags.fwd", result.fif, i)
-                 res.set_result_value("ecnspider.synflags.fwd", result.fsf, i)
-                 res.set_result_value("ecnspider.unionflags.fwd", result.fuf, i)
-                 res.set_result_value("ecnspider.initflags.rev", result.fir, i)
-                 res.set_result_value("ecnspider.synflags.rev", result.fsr, i)
-                 res.set_result_value("ecnspider.unionflags.rev", result.fur, i)
-                 res.set_result_value("ecnspider.ttl.rev.min", result.ttl, i)
-            print("ecnspider2: returning {} records".format(len(result_sink)))
+            print("ecnspider2: returning {} records".format(len(records)))
         except Exception as e:
+            if jnl is not None:
+                jnl.close()
+            self.streams.pop(token, None)
             self.singleton_lock.release()
             raise e
         else:
             self.singleton_lock.release()
             return res
 
+class EcnspiderService(EcnspiderServiceBase):
+    spider_class = ecnspider.EcnSpider2
+
+    def make_jobs(self, spec, ips):
+        ports = spec.get_parameter_value("destination.port")
+        if len(ports) != len(ips):
+            raise ValueError("destination.ip4/6, destination.port and torrentspider.nodeid don't have same amount of elements.")
+
+        return (ecnspider.Job(ip_address(ip), ip, port, None) for ip, port in zip(ips, ports))
+
 def ecnspider_http_cap(ip_version):
     ipv = "ip"+str(ip_version)
 
@@ -203,89 +413,105 @@ def ecnspider_http_cap(ip_version):
     cap.add_result_column("ecnspider.synflags.rev")
     cap.add_result_column("ecnspider.unionflags.rev")
     cap.add_result_column("ecnspider.ttl.rev.min")
+    cap.add_result_column("ecnspider.early")
 
     return cap
 
-class EcnspiderHttpService(mplane.scheduler.Service):
-    def __init__(self, cap, worker_count, connection_timeout, interface_uri, qof_port, singleton_lock, ip4addr=None, ip6addr=None):
-        super().__init__(cap)
+class EcnspiderHttpService(EcnspiderServiceBase):
+    spider_class = ecnspider.EcnSpider2Http
 
-        self.worker_count = int(worker_count)
-        self.connection_timeout = float(connection_timeout)
-        self.interface_uri = interface_uri
-        self.qof_port = int(qof_port)
-        self.ip4addr = ip4addr
-        self.ip6addr = ip6addr
-        self.singleton_lock = singleton_lock
+    def make_jobs(self, spec, ips):
+        ports = spec.get_parameter_value("destination.port")
+        if len(ports) != len(ips):
+            raise ValueError("destination.ip4/6 and destination.port don't have same amount of elements.")
 
-    def run(self, spec, check_interrupt):
-        # try to acquire lock or immediately return error
-        if not self.singleton_lock.acquire(blocking=False):
-            raise Exception("An instance of ecnspider is already running.")
+        hosts = spec.get_parameter_value("ecnspider.hostname")
+        if len(hosts) != len(ips):
+            raise ValueError("ecnspider.hostname and destination.ip4/6 don't have same amount of elements.")
 
-        try:
-            # wrap the spec in a job source, either ipv4 or ipv6
-            if spec.has_parameter("destination.ip4"):
-                ips = spec.get_parameter_value("destination.ip4")
-                ipv = "ip4"
-            else:
-                ips = spec.get_parameter_value("destination.ip6")
-                ipv = "ip6"
+        return (ecnspider.Job(ip_address(ip), host, port, None) for ip, port, host in zip(ips, ports, hosts))
 
-            # setup ecnspider
-            result_sink = collections.deque()
-            ecn = ecnspider.EcnSpider2Http(result_sink.append,
-                    worker_count=self.worker_count,
-                    conn_timeout=self.connection_timeout,
-                    interface_uri=self.interface_uri, local_ip4=self.ip4addr,
-                    local_ip6=self.ip6addr, qof_port=self.qof_port,
-                    check_interrupt=check_interrupt)
-
-            # formulate jobs
-            ports = spec.get_parameter_value("destination.port")
-            if len(ports) != len(ips):
-                raise ValueError("destination.ip4/6 and destination.port don't have same amount of elements.")
-
-            hosts = spec.get_parameter_value("ecnspider.hostname")
-            if len(hosts) != len(ips):
-                raise ValueError("ecnspider.hostname and destination.ip4/6 don't have same amount of elements.")
-
-            jobs = [ecnspider.Job(ip_address(ip), host, port, None) for ip, port, host in zip(ips, ports, hosts)]
-            for job in jobs:
-                ecn.add_job(job)
-
-            # run measurement
-            starttime = datetime.utcnow()
-            ecn.run()
-            ecn.stop()
-            if ecn.exception is not None:
-                raise ecn.exception
-            stoptime = datetime.utcnow()
+def ecnspider_https_cap(ip_version):
+    ipv = "ip"+str(ip_version)
 
-            res = mplane.model.Result(specification=spec)
-            res.set_when(mplane.model.When(a=starttime, b=stoptime))
+    cap = mplane.model.Capability(label='ecnspider-https-'+ipv, when='now ... future')
 
-            for i, result in enumerate(result_sink):
-                res.set_result_value("source.port", result.port, i)
-                res.set_result_value("destination."+ipv, result.ip, i)
-                res.set_result_value("destination.port", result.rport, i)
-                res.set_result_value("connectivity.ip", result.connstate, i)
-                res.set_result_value("ecnspider.hostname", result.host)
-                res.set_result_value("ecnspider.ecnstate", result.ecnstate, i)
-                res.set_result_value("ecnspider.httpstatus", result.httpstatus)
-                res.set_result_value("ecnspider.initflags.fwd", result.fif, i)
-                res.set_result_value("ecnspider.synflags.fwd", result.fsf, i)
-                res.set_result_value("ecnspider.unionflags.fwd", result.fuf, i)
-                res.set_result_value("ecnspider.initflags.rev", result.fir, i)
-                res.set_result_value("ecnspider.synflags.rev", result.fsr, i)
-                res.set_result_value("ecnspider.unionflags.rev", result.fur, i)
-                res.set_result_value("ecnspider.ttl.rev.min", result.ttl, i)
-
-            print("ecnspider2: returning {} records".format(len(result_sink)))
-        except Exception as e:
-            self.singleton_lock.release()
-            raise e
-        else:
-            self.singleton_lock.release()
-            return res
+    cap.add_parameter("destination."+ipv, "[*]")
+    cap.add_parameter("destination.port", "[*]")
+    cap.add_parameter("ecnspider.hostname", "[*]")
+
+    cap.add_result_column("source.port")
+    cap.add_result_column("destination."+ipv)
+    cap.add_result_column("destination.port")
+    cap.add_result_column("ecnspider.hostname")
+    cap.add_result_column("connectivity.ip")
+    cap.add_result_column("ecnspider.tls.handshake")
+    cap.add_result_column("ecnspider.ecnstate")
+    cap.add_result_column("ecnspider.initflags.fwd")
+    cap.add_result_column("ecnspider.synflags.fwd")
+    cap.add_result_column("ecnspider.unionflags.fwd")
+    cap.add_result_column("ecnspider.initflags.rev")
+    cap.add_result_column("ecnspider.synflags.rev")
+    cap.add_result_column("ecnspider.unionflags.rev")
+    cap.add_result_column("ecnspider.ttl.rev.min")
+    cap.add_result_column("ecnspider.early")
+
+    return cap
+
+class EcnspiderHttpsService(EcnspiderHttpService):
+    spider_class = ecnspider.EcnSpider2Tls
+
+def ecnspider_fetch_cap(ip_version):
+    ipv = "ip"+str(ip_version)
+
+    cap = mplane.model.Capability(label='ecnspider-fetch-'+ipv, when='now')
+
+    cap.add_parameter("ecnspider.token")
+
+    cap.add_result_column("source.port")
+    cap.add_result_column("destination."+ipv)
+    cap.add_result_column("destination.port")
+    cap.add_result_column("ecnspider.hostname")
+    cap.add_result_column("connectivity.ip")
+    cap.add_result_column("ecnspider.httpstatus")
+    cap.add_result_column("ecnspider.tls.handshake")
+    cap.add_result_column("ecnspider.ecnstate")
+    cap.add_result_column("ecnspider.initflags.fwd")
+    cap.add_result_column("ecnspider.synflags.fwd")
+    cap.add_result_column("ecnspider.unionflags.fwd")
+    cap.add_result_column("ecnspider.initflags.rev")
+    cap.add_result_column("ecnspider.synflags.rev")
+    cap.add_result_column("ecnspider.unionflags.rev")
+    cap.add_result_column("ecnspider.ttl.rev.min")
+    cap.add_result_column("ecnspider.early")
+
+    return cap
+
+class EcnspiderFetchService(mplane.scheduler.Service):
+    """
+    Returns the records a running ecnspider, ecnspider-http or
+    ecnspider-https measurement, identified by the token of its
+    specification, has merged since the last fetch. Fetched records are
+    dropped from the probe, and are not part of the measurement's final
+    result.
+    """
+
+    def __init__(self, cap, streams):
+        super().__init__(cap)
+        self.streams = streams
+
+    def run(self, spec, check_interrupt):
+        token = spec.get_parameter_value("ecnspider.token")
+        result_sink = self.streams.get(token)
+        if result_sink is None:
+            raise ValueError("No ecnspider measurement with token {} is running.".format(token))
+
+        starttime = datetime.utcnow()
+        records = result_sink.take()
+
+        res = mplane.model.Result(specification=spec)
+        res.set_when(mplane.model.When(a=starttime, b=datetime.utcnow()))
+        export_records(res, records)
 
+        print("ecnspider2: returning {} streamed records".format(len(records)))
+        return res
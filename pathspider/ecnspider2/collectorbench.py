@@ -0,0 +1,150 @@
+"""
+Ecnspider2: Qofspider-based tool for measuring ECN-linked connectivity
+Derived from ECN Spider (c) 2014 Damiano Boppart <hat.guy.repo@gmail.com>
+
+Micro-benchmark comparing the 'dict' and 'compiled' IPFIX collectors on a
+QoF output stream. Run from the pathspider directory:
+
+    python -m ecnspider2.collectorbench [--local-ip4 ADDR] [FILE]
+
+FILE is an IPFIX file as written by qof with the ecnspider template
+(``qof --yaml qof.yaml --in ... --out FILE``), and --local-ip4 the address
+the spider measured from. Without a file, a stream of synthetic flows is
+generated.
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+
+from ipaddress import ip_address
+from datetime import datetime
+import argparse
+import io
+import time
+
+import ipfix.reader
+import ipfix.writer
+import ipfix.template
+import ipfix.ie
+
+from . import ecnspider
+from . import qofspider
+
+def bench_spider(local_ip4, local_ip6, spider_class=ecnspider.EcnSpider2):
+    """Make a spider which can decode flows, without starting anything."""
+    spider = spider_class.__new__(spider_class)
+    spider.local_ip4 = local_ip4
+    spider.local_ip6 = local_ip6
+    spider.sources = qofspider.SourceSet([local_ip4, local_ip6])
+    spider.bind_sources = []
+    spider.port_pool = None
+    return spider
+
+def synthetic_stream(count, local_ip4):
+    """
+    Generate an IPFIX stream of count biflows from local_ip4, using the
+    template ecnspider configures QoF with (less IPv6 addresses). One in
+    eight flows is a UDP flow and one in eight a reset, as filler.
+    """
+    names = [name for name in bench_spider(None, None).qof_config()['template']
+             if 'IPv6' not in name]
+    tmpl = ipfix.template.from_ielist(256, ipfix.ie.spec_list(names))
+
+    stream = io.BytesIO()
+    writer = ipfix.writer.to_stream(stream)
+    writer.set_domain(1)
+    writer.add_template(tmpl)
+    writer.set_export_template(256)
+
+    now = datetime.utcnow()
+    for i in range(count):
+        rec = {name: 0 for name in names}
+        rec.update({'flowStartMilliseconds': now,
+                    'flowEndMilliseconds': now,
+                    'sourceIPv4Address': local_ip4,
+                    'destinationIPv4Address': ip_address(0x0a000000 + i),
+                    'sourceTransportPort': 1024 + i % 60000,
+                    'destinationTransportPort': 80,
+                    'protocolIdentifier': 17 if i % 8 == 1 else 6,
+                    'initialTCPFlags': 0x04 if i % 8 == 2 else 0xc2,
+                    'reverseInitialTCPFlags': 0x52,
+                    'unionTCPFlags': 0xdb,
+                    'reverseUnionTCPFlags': 0x5b,
+                    'lastSynTcpFlags': 0xc2,
+                    'reverseLastSynTcpFlags': 0x52,
+                    'qofTcpCharacteristics': 0x7111,
+                    'reverseQofTcpCharacteristics': 0x7100,
+                    'reverseMinimumTTL': 50,
+                    'reverseTransportOctetDeltaCount': 1200 + i})
+        writer.export_namedict(rec)
+    writer.flush()
+
+    return stream.getvalue()
+
+def run_dict(spider, data):
+    reader = ipfix.reader.from_stream(io.BytesIO(data))
+    flows = []
+    for d in reader.namedict_iterator():
+        tf = spider.tupleize_flow(d)
+        if tf:
+            flows.append(tf)
+    return flows
+
+def run_compiled(spider, data):
+    reader = qofspider.FlowReader(spider.compile_tupleizer, spider.tupleize_flow)
+    return list(reader.iterator(io.BytesIO(data)))
+
+def bench(spider, data, repeat=3):
+    """
+    Decode data with both collectors, check that they agree, and return the
+    best time of each in seconds together with the number of flow records.
+    """
+    flows = run_dict(spider, data)
+    if run_compiled(spider, data) != flows:
+        raise AssertionError("collectors disagree")
+
+    times = {}
+    for name, fn in (('dict', run_dict), ('compiled', run_compiled)):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn(spider, data)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times[name] = best
+
+    return times, len(flows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the ecnspider IPFIX collectors.')
+    parser.add_argument('file', nargs='?', help='IPFIX file written by qof')
+    parser.add_argument('--local-ip4', default='192.0.2.1', help='address the flows were measured from')
+    parser.add_argument('--local-ip6', default='2001:db8::1', help='IPv6 address the flows were measured from')
+    parser.add_argument('--count', type=int, default=100000, help='number of synthetic flows')
+    args = parser.parse_args()
+
+    spider = bench_spider(ip_address(args.local_ip4), ip_address(args.local_ip6))
+    if args.file:
+        with open(args.file, 'rb') as f:
+            data = f.read()
+    else:
+        data = synthetic_stream(args.count, spider.local_ip4)
+
+    times, count = bench(spider, data)
+    for name, elapsed in sorted(times.items()):
+        print("{:9s} {:8.3f}s {:10.0f} records/s".format(name, elapsed, count / elapsed))
+
+if __name__ == '__main__':
+    main()
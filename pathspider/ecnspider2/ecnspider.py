@@ -23,6 +23,7 @@ Derived from ECN Spider (c) 2014 Damiano Boppart <hat.guy.repo@gmail.com>
 
 from ipaddress import ip_address
 import http.client
+import ssl
 import collections
 import socket
 import logging
@@ -32,6 +33,11 @@ import time
 import sys
 import ipfix
 import itertools
+import struct
+import errno
+from datetime import timezone
+import os
+import stat
 from . import qofspider
 
 # Flags constants
@@ -62,41 +68,163 @@ Connection = collections.namedtuple("Connection", ["client", "port", "state"])
 CONN_OK = 0
 CONN_FAILED = 1
 CONN_TIMEOUT = 2
+CONN_SKIPPED = 3
+
+# Early exit: how configuration one was cut short after configuration zero
+# timed out, and the timeout of a probe connect
+EARLY_NONE = 0
+EARLY_PROBE = 1
+EARLY_SKIP = 2
+EARLY_PROBE_TIMEOUT = 1.0
+
+# Linux sysctl controlling ECN negotiation, and the helper script (see
+# bin/ecnspider-tcp-ecn) which writes it for the 'proc' sysctl method
+PROC_TCP_ECN = '/proc/sys/net/ipv4/tcp_ecn'
+PROC_HELPER = '/usr/local/bin/ecnspider-tcp-ecn'
+
+# Congestion control algorithm used to request ECN per socket
+ECN_SOCKET_CC = 'dctcp'
+TCP_CONGESTION = getattr(socket, 'TCP_CONGESTION', 13)
+
+# Attempts to bind a socket to a pool port before giving up
+PORT_BIND_TRIES = 3
 
 # HTTP constants
 USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:28.0) Gecko/20100101 Firefox/28.0'
 
+# Raw HTTP probe: the request around the Host header, and the most bytes
+# read while looking for the status line
+HTTP_REQUEST_HEAD = b'GET / HTTP/1.1\r\nHost: '
+HTTP_REQUEST_TAIL = ('\r\nUser-Agent: ' + USER_AGENT + '\r\nConnection: close\r\n\r\n').encode('latin-1')
+HTTP_READ_BUDGET = 1024
+
 SpiderRecord = collections.namedtuple("SpiderRecord",
     ["ip", "host", "port", "rport", "ecnstate", "connstate", "httpstatus",
-        "userval"])
+        "userval", "src", "gen", "early", "tls"])
 
 FlowRecord = collections.namedtuple("FlowRecord",
-    ["ip", "port", "octets", "fif", "fsf", "fuf", "fir", "fsr", "fur", "ttl"])
+    ["ip", "port", "octets", "fif", "fsf", "fuf", "fir", "fsr", "fur", "ttl",
+        "src", "gen"])
 
 MergedRecord = collections.namedtuple("MergedRecord",
     ["ip", "host", "port", "rport", "ecnstate", "connstate", "httpstatus",
-        "userval", "octets", "fif", "fsf", "fuf", "fir", "fsr", "fur", "ttl"])
+        "userval", "octets", "fif", "fsf", "fuf", "fir", "fsr", "fur", "ttl",
+        "early", "tls"])
 
 Job = collections.namedtuple("Job", ["ip", "host", "rport", "userval"])
 
 class EcnSpider2(qofspider.QofSpider):
+    # if set, only flows towards this port are merged
+    flow_port = None
+
     def __init__(self, result_sink,
                  worker_count, conn_timeout,
                  interface_uri,
                  local_ip4=None, local_ip6=None,
                  qof_port=4739,
-                 check_interrupt=None):
-        super().__init__(worker_count=worker_count, interface_uri=interface_uri, qof_port=qof_port, check_interrupt=check_interrupt)
+                 check_interrupt=None,
+                 engine='thread', engine_threads=qofspider.ENGINE_THREADS,
+                 scheduler='semaphore', phase_batch=None, phase_deadline=qofspider.PHASE_DEADLINE,
+                 sysctl_method='exec', ecn_mode='sysctl', ecn_cc=ECN_SOCKET_CC,
+                 table_ttl=qofspider.TABLE_TTL, table_size=qofspider.TABLE_SIZE,
+                 collector='dict', local_sources=None, bind_sources=None,
+                 port_range=None, port_quarantine=qofspider.PORT_QUARANTINE,
+                 adaptive_timeout=None, timeout_floor=qofspider.TIMEOUT_FLOOR,
+                 early_exit=None, probe_timeout=EARLY_PROBE_TIMEOUT,
+                 proc_helper=PROC_HELPER):
+        """
+        With ``ecn_mode='sysctl'``, ECN negotiation is switched system-wide
+        by flipping the sysctl between the two configurations. With
+        ``ecn_mode='socket'``, the sysctl stays in configuration zero and
+        configuration one sockets request ECN by using a congestion control
+        algorithm which requires it (``ecn_cc``, DCTCP by default; linux
+        only). Note that the kernel then also marks the SYN itself ECT(0).
+
+        Flows are merged if they originate from ``local_ip4``, ``local_ip6``
+        or any address or prefix in ``local_sources``; all others are
+        dropped by the collector.
+
+        If ``bind_sources`` lists local addresses, each target is measured
+        from one of them (chosen by target address, from those of its IP
+        version), and flows and results are joined on the source address
+        as well. With the 'semaphore' scheduler, each source address is
+        served by its own subset of the workers.
+
+        If ``port_range`` is a ``(first, last)`` pair, source ports are
+        taken from that range instead of the kernel's ephemeral range, and
+        rest for ``port_quarantine`` seconds after use. Flows and results
+        are then also joined on the generation of their source port. The
+        range should not overlap the kernel's ephemeral port range. With
+        ``bind_sources``, each source address takes its ports from its own
+        slice of the range.
+
+        With ``adaptive_timeout`` set to ``'run'`` or ``'prefix'``, connects
+        time out after a multiple of the tail of the handshake times seen
+        so far, across the run or per /24, but never before
+        ``timeout_floor`` nor after ``conn_timeout`` seconds (see
+        :class:`qofspider.AdaptiveTimeout`).
+
+        If configuration zero of a target timed out, ``early_exit='probe'``
+        tries configuration one with a timeout of ``probe_timeout`` only,
+        and ``early_exit='skip'`` does not try it at all. The record of
+        configuration one then says so in its ``early`` field. Early exit
+        is not available with ``ecn_mode='socket'``, where both
+        configurations are tried at once.
+
+        With ``sysctl_method='proc'``, a spider which may not write the
+        sysctl itself runs ``proc_helper`` through sudo to write it.
+        """
+        if ecn_mode not in ('sysctl', 'socket'):
+            raise ValueError("Unknown ECN mode '{}'.".format(ecn_mode))
+        if early_exit not in (None, 'probe', 'skip'):
+            raise ValueError("Unknown early exit policy '{}'.".format(early_exit))
+
+        super().__init__(worker_count=worker_count, interface_uri=interface_uri, qof_port=qof_port, check_interrupt=check_interrupt,
+                         engine=engine, engine_threads=engine_threads,
+                         scheduler=scheduler, phase_batch=phase_batch, phase_deadline=phase_deadline,
+                         concurrent_configs=(ecn_mode == 'socket'),
+                         table_ttl=table_ttl, table_size=table_size,
+                         collector=collector, job_shards=len(bind_sources or []))
 
         self.conn_timeout = conn_timeout
         self.result_sink = result_sink
 
-        if sys.platform == 'linux':
+        if early_exit is not None and ecn_mode == 'socket':
+            logging.getLogger('ecnspider').warning("early exit is not available in socket ECN mode")
+            early_exit = None
+        self.early_exit = early_exit
+        self.probe_timeout = probe_timeout
+
+        # connect timeout following observed handshake times
+        self.timer = None
+        self.connect_starts = {}
+        if adaptive_timeout:
+            self.timer = qofspider.AdaptiveTimeout(conn_timeout, floor=timeout_floor,
+                                                   scope=adaptive_timeout)
+
+        if sys.platform == 'linux' and sysctl_method == 'proc':
+            self.configurator_hooks = EcnSpider2ConfigLinuxProc(helper=proc_helper)
+        elif sys.platform == 'linux':
             self.configurator_hooks = EcnSpider2ConfigLinux()
-        elif sys.platform == 'darwin':
+        elif sys.platform == 'darwin' and sysctl_method != 'proc':
             self.configurator_hooks = EcnSpider2ConfigDarwin()
         else:
-            raise NotImplementedError("ECN configurator for your system {} is not implemented.".format(sys.platform))
+            raise NotImplementedError("ECN configurator '{}' for your system {} is not implemented.".format(sysctl_method, sys.platform))
+
+        self.ecn_cc = None
+        if ecn_mode == 'socket':
+            if sys.platform != 'linux':
+                raise NotImplementedError("Per-socket ECN for your system {} is not implemented.".format(sys.platform))
+
+            # fail early if the congestion control is not available to us
+            self.ecn_cc = ecn_cc.encode()
+            with socket.socket() as sock:
+                sock.setsockopt(socket.IPPROTO_TCP, TCP_CONGESTION, self.ecn_cc)
+
+        # configuration flip timing
+        self.flip_count = 0
+        self.flip_time = 0.0
+        self.flip_time_max = 0.0
 
         if local_ip4:
             self.local_ip4 = ip_address(local_ip4) if isinstance(local_ip4, str) else local_ip4
@@ -104,38 +232,248 @@ class EcnSpider2(qofspider.QofSpider):
             self.local_ip4 = qofspider.local_address(ipv=4)
 
         if local_ip6:
-            self.local_ip6 = ip_address(local_ip4) if isinstance(local_ip6, str) else local_ip6
+            self.local_ip6 = ip_address(local_ip6) if isinstance(local_ip6, str) else local_ip6
         else:
             self.local_ip6 = qofspider.local_address(ipv=6)
 
+        # source addresses to spread jobs across
+        self.bind_sources = [ip_address(source) if isinstance(source, str) else source
+                             for source in (bind_sources or [])]
+        self.bind_pools = {4: [source for source in self.bind_sources if source.version == 4],
+                           6: [source for source in self.bind_sources if source.version == 6]}
+        self.bind_shards = {source: i for i, source in enumerate(self.bind_sources)}
+
+        # managed source ports, a slice of the range per source address
+        self.port_pool = None
+        if port_range is not None:
+            self.port_pool = qofspider.PortPool(port_range[0], port_range[1], port_quarantine,
+                                                shards=max(1, len(self.bind_sources)))
+
+        # flows from any of these are ours
+        self.sources = qofspider.SourceSet([self.local_ip4, self.local_ip6] +
+                                           list(local_sources or []) +
+                                           self.bind_sources)
+
     def config_one(self):
-        self.configurator_hooks.config_one()
+        self.timed_flip(self.configurator_hooks.config_one)
 
     def config_zero(self):
-        self.configurator_hooks.config_zero()
+        self.timed_flip(self.configurator_hooks.config_zero)
+
+    def timed_flip(self, flip):
+        start = time.perf_counter()
+        flip()
+        elapsed = time.perf_counter() - start
+
+        self.flip_count += 1
+        self.flip_time += elapsed
+        self.flip_time_max = max(self.flip_time_max, elapsed)
+
+    def flip_stats(self):
+        """
+        :returns: a dict with the number of configuration flips and the total,
+                  mean and maximum time they took in seconds.
+        """
+        return {'count': self.flip_count,
+                'total': self.flip_time,
+                'mean': self.flip_time / self.flip_count if self.flip_count > 0 else 0.0,
+                'max': self.flip_time_max}
+
+    def stop(self):
+        super().stop()
+        logging.getLogger('ecnspider').info("configuration flips: {}".format(self.flip_stats()))
+        if self.port_pool is not None and self.port_pool.exhausted > 0:
+            logging.getLogger('ecnspider').warning("source port pool exhausted {} times".format(self.port_pool.exhausted))
+        if self.timer is not None:
+            logging.getLogger('ecnspider').info("adaptive timeout: {}".format(self.timer.stats()))
+        self.configurator_hooks.close()
+
+    def terminate(self):
+        super().terminate()
+        self.configurator_hooks.close()
+
+    def job_source(self, job):
+        """
+        :returns: the local address to measure job from, or None to leave
+                  it to the kernel.
+        """
+        pool = self.bind_pools[job.ip.version]
+        if not pool:
+            return None
+        return pool[int(job.ip) % len(pool)]
+
+    def job_shard(self, job):
+        source = self.job_source(job)
+        if source is None:
+            return 0
+        return self.bind_shards[source]
+
+    def merge_key(self, rec):
+        key = (rec.ip, rec.port)
+        if self.bind_sources:
+            key += (rec.src,)
+        if self.port_pool is not None:
+            key += (rec.gen,)
+        return key
+
+    def port_generation(self, port):
+        if self.port_pool is None:
+            return None
+        return self.port_pool.generation(port)
 
-    def connect(self, job, pcs, config):
+    def release_port(self, port):
+        if self.port_pool is not None:
+            self.port_pool.release(port)
+
+    def make_socket(self, job, config):
         if job.ip.version == 4:
             sock = socket.socket()
         else:
             sock = socket.socket(socket.AF_INET6)
 
+        source = self.job_source(job)
+        address = '' if source is None else str(source)
+
+        bound = False
+        if self.port_pool is not None:
+            # bind to a port of our own, skipping ports taken by others or
+            # still in TIME_WAIT
+            for _ in range(PORT_BIND_TRIES):
+                port = self.port_pool.acquire(self.job_shard(job))
+                if port is None:
+                    break
+                try:
+                    sock.bind((address, port))
+                    bound = True
+                    break
+                except OSError as e:
+                    self.port_pool.release(port)
+                    if e.errno != errno.EADDRINUSE:
+                        raise
+
+            # no pool port to be had, leave the port to the kernel
+
+        if source is not None and not bound:
+            sock.bind((address, 0))
+
+        if config == 1 and self.ecn_cc is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_CONGESTION, self.ecn_cc)
+
+        return sock
+
+    def pre_connect(self, job):
+        # remembers whether configuration zero timed out
+        if self.early_exit is None:
+            return None
+        return {'timeout0': False}
+
+    def early_state(self, pcs, config):
+        if config == 1 and pcs is not None and pcs['timeout0']:
+            return EARLY_SKIP if self.early_exit == 'skip' else EARLY_PROBE
+        return EARLY_NONE
+
+    def mark_timeout(self, pcs, config):
+        if config == 0 and pcs is not None:
+            pcs['timeout0'] = True
+
+    def skip_connect(self, job, pcs, config):
+        if self.early_state(pcs, config) == EARLY_SKIP:
+            return Connection(None, None, CONN_SKIPPED)
+        return None
+
+    def expects_flow(self, res):
+        # no flow is merged with skipped connects, or with connects which
+        # never got a port (failed http connects, phase deadline expiries)
+        return res.early != EARLY_SKIP and res.port not in (0, None)
+
+    def job_timeout(self, job, pcs, config):
+        if self.timer is None:
+            timeout = self.conn_timeout
+        else:
+            timeout = self.timer.timeout(job.ip)
+
+        if self.early_state(pcs, config) == EARLY_PROBE:
+            timeout = min(timeout, self.probe_timeout)
+        return timeout
+
+    def connect(self, job, pcs, config):
+        sock = self.make_socket(job, config)
+
+        start = time.monotonic()
         try:
-            sock.settimeout(self.conn_timeout)
+            sock.settimeout(self.job_timeout(job, pcs, config))
             sock.connect((str(job.ip), job.rport))
+            if self.timer is not None:
+                self.timer.handshake(job.ip, time.monotonic() - start)
+
+            # the connect may have had a shorter timeout than what follows
+            sock.settimeout(self.conn_timeout)
 
             return Connection(sock, sock.getsockname()[1], CONN_OK)
-        except TimeoutError:
+        except socket.timeout:
+            if self.timer is not None:
+                self.timer.expired(time.monotonic() - start)
+            self.mark_timeout(pcs, config)
             return Connection(sock, sock.getsockname()[1], CONN_TIMEOUT)
         except OSError as e:
             return Connection(sock, sock.getsockname()[1], CONN_FAILED)
 
-    def post_connect(self, job, conn, pcs, config):
-        if conn.state == CONN_OK:
-            sr = SpiderRecord(job.ip, job.host, conn.port, job.rport, config, True, 0, job.userval)
+    def start_connect(self, job, pcs, config):
+        sock = self.make_socket(job, config)
+
+        sock.setblocking(False)
+        if self.timer is not None:
+            self.connect_starts[sock] = time.monotonic()
+        return sock, sock.connect_ex((str(job.ip), job.rport))
+
+    def finish_connect(self, job, pcs, config, sock, err):
+        # hand a blocking socket to post_connect, as connect() does
+        sock.settimeout(self.conn_timeout)
 
+        start = self.connect_starts.pop(sock, None)
+
+        if err == 0:
+            if start is not None:
+                self.timer.handshake(job.ip, time.monotonic() - start)
+            return Connection(sock, sock.getsockname()[1], CONN_OK)
+        elif err is None:
+            if start is not None:
+                self.timer.expired(time.monotonic() - start)
+            self.mark_timeout(pcs, config)
+            return Connection(sock, sock.getsockname()[1], CONN_TIMEOUT)
         else:
-            sr = SpiderRecord(job.ip, job.host, conn.port, job.rport, config, False, 0, job.userval)
+            return Connection(sock, sock.getsockname()[1], CONN_FAILED)
+
+    def connect_timeout(self, job, pcs, config):
+        return self.job_timeout(job, pcs, config)
+
+    def expire_connect(self, job, pcs, config):
+        # the result has no port, so it goes to unmatched at once
+        self.mark_timeout(pcs, config)
+        return Connection(None, 0, CONN_TIMEOUT)
+
+    def discard_connect(self, job, conn, pcs, config):
+        try:
+            conn.client.close()
+        except:
+            pass
+        self.release_port(conn.port)
+
+    def spider_record(self, job, conn, pcs, config, **overrides):
+        """
+        Return the SpiderRecord of a connection. Fields which a spider
+        measures beyond the connect, e.g. ``httpstatus``, are passed as
+        keyword arguments.
+        """
+        values = dict(port=conn.port, connstate=(conn.state == CONN_OK), httpstatus=0, tls=None)
+        values.update(overrides)
+        return SpiderRecord(ip=job.ip, host=job.host, rport=job.rport, ecnstate=config,
+                            userval=job.userval, src=self.job_source(job),
+                            gen=self.port_generation(conn.port),
+                            early=self.early_state(pcs, config), **values)
+
+    def post_connect(self, job, conn, pcs, config):
+        sr = self.spider_record(job, conn, pcs, config)
 
         try:
             conn.client.shutdown(socket.SHUT_RDWR)
@@ -146,6 +484,7 @@ class EcnSpider2(qofspider.QofSpider):
             conn.client.close()
         except:
             pass
+        self.release_port(conn.port)
 
         return sr
 
@@ -181,10 +520,12 @@ class EcnSpider2(qofspider.QofSpider):
                  'force-biflow': 1}
 
     def ignore_flow(self, flow):
-        # Short-circuit non-TCP flows, and reset storms
+        # Short-circuit non-TCP flows, flows to other ports, and reset storms
         try:
             if flow["protocolIdentifier"] != 6:
                 return True
+            if self.flow_port is not None and flow["destinationTransportPort"] != self.flow_port:
+                return True
             if flow["initialTCPFlags"] & TCP_RST:
                 return True
         except:
@@ -196,13 +537,15 @@ class EcnSpider2(qofspider.QofSpider):
         if self.ignore_flow(flow):
             return None
 
-        # Short-circuit flows not from this source,
+        # Short-circuit flows not from our sources,
         # and select destination address based on version
         if ("sourceIPv4Address" in flow and
-          flow["sourceIPv4Address"] == self.local_ip4):
+          flow["sourceIPv4Address"] in self.sources):
+            src = flow["sourceIPv4Address"]
             ip = flow["destinationIPv4Address"]
         elif ("sourceIPv6Address" in flow and
-          flow["sourceIPv6Address"] == self.local_ip6):
+          flow["sourceIPv6Address"] in self.sources):
+            src = flow["sourceIPv6Address"]
             ip = flow["destinationIPv6Address"]
         else:
             return None
@@ -224,46 +567,180 @@ class EcnSpider2(qofspider.QofSpider):
 
         rtodc = flow["reverseTransportOctetDeltaCount"]
 
+        # Source address is only kept when sharding across sources
+        if not self.bind_sources:
+            src = None
+
+        # Generation of the source port this flow was made with
+        gen = None
+        if self.port_pool is not None:
+            start = flow["flowStartMilliseconds"].replace(tzinfo=timezone.utc).timestamp()
+            gen = self.port_pool.generation_at(flow["sourceTransportPort"], start)
+
         # Export record
         return FlowRecord(ip,
                           flow["sourceTransportPort"],
                           rtodc,
-                          fif, fsf, fuf, fir, fsr, fur, ttl)
+                          fif, fsf, fuf, fir, fsr, fur, ttl, src, gen)
+
+    def compile_tupleizer(self, tmpl):
+        # Select the address family of this template; leave templates
+        # with both families (or neither) to the dict collector
+        names = [ie.name for ie in tmpl.ies]
+        if "sourceIPv4Address" in names and "sourceIPv6Address" not in names:
+            src, dst, version = "sourceIPv4Address", "destinationIPv4Address", 4
+        elif "sourceIPv6Address" in names and "sourceIPv4Address" not in names:
+            src, dst, version = "sourceIPv6Address", "destinationIPv6Address", 6
+        else:
+            return None
+
+        # None of our sources can appear in this template
+        if not self.sources.has_version(version):
+            return (struct.Struct("!{}x".format(tmpl.minlength)), lambda v: None)
+
+        fields = [src, dst, "protocolIdentifier",
+                  "sourceTransportPort", "destinationTransportPort",
+                  "initialTCPFlags", "lastSynTcpFlags", "unionTCPFlags",
+                  "qofTcpCharacteristics",
+                  "reverseInitialTCPFlags", "reverseLastSynTcpFlags",
+                  "reverseUnionTCPFlags", "reverseQofTcpCharacteristics",
+                  "reverseMinimumTTL", "reverseTransportOctetDeltaCount",
+                  "flowStartMilliseconds"]
+        if any(name not in names for name in fields):
+            return None
+
+        # Unpack the fields we need and skip over everything else
+        fmt = "!"
+        order = []
+        for ie in tmpl.ies:
+            if ie.name in fields and ie.name not in order:
+                fmt += ie.type.stel
+                order.append(ie.name)
+            else:
+                fmt += "{}x".format(ie.length)
+
+        (i_src, i_dst, i_proto, i_sport, i_dport,
+         i_fif, i_fsf, i_fuf, i_qc,
+         i_fir, i_fsr, i_fur, i_rqc,
+         i_ttl, i_rtodc, i_start) = (order.index(name) for name in fields)
+
+        addresses = self.sources.addresses
+        contains = self.sources.contains_packed if self.sources.prefixes else None
+        flow_port = self.flow_port
+        keep_src = bool(self.bind_sources)
+        port_pool = self.port_pool
+
+        def convert(v):
+            # Short-circuit flows not from our sources, then non-TCP
+            # flows, reset storms and flows to other ports
+            if v[i_src] not in addresses and (contains is None or not contains(v[i_src])):
+                return None
+            if v[i_proto] != 6 or v[i_fif] & TCP_RST:
+                return None
+            if flow_port is not None and v[i_dport] != flow_port:
+                return None
+
+            qc = v[i_qc]
+            rqc = v[i_rqc]
+            return FlowRecord(ip_address(v[i_dst]), v[i_sport], v[i_rtodc],
+                              v[i_fif],
+                              v[i_fsf] | (qc & 0xFF00),
+                              v[i_fuf] | ((qc & 0xFF) << 8),
+                              v[i_fir],
+                              v[i_fsr] | (rqc & 0xFF00),
+                              v[i_fur] | ((rqc & 0xFF) << 8),
+                              v[i_ttl],
+                              ip_address(v[i_src]) if keep_src else None,
+                              None if port_pool is None else
+                                  port_pool.generation_at(v[i_sport], v[i_start] / 1000))
+
+        return (struct.Struct(fmt), convert)
 
 
     def merge(self, flow, res):
         self.result_sink(MergedRecord(res.ip, res.host, res.port, res.rport,
                 res.ecnstate, res.connstate, res.httpstatus, res.userval,
                 flow.octets, flow.fif, flow.fsf, flow.fuf,
-                flow.fir, flow.fsr, flow.fur, flow.ttl))
+                flow.fir, flow.fsr, flow.fur, flow.ttl, res.early, res.tls))
+
+    def unmatched(self, res):
+        # export without flow data
+        self.result_sink(MergedRecord(res.ip, res.host, res.port, res.rport,
+                res.ecnstate, res.connstate, res.httpstatus, res.userval,
+                None, None, None, None, None, None, None, None, res.early, res.tls))
 
 
 
 class EcnSpider2Http(EcnSpider2):
-    def __init__(self, result_sink,
-                 worker_count, conn_timeout,
-                 interface_uri,
-                 local_ip4=None, local_ip6=None,
-                 qof_port=4739,
-                 check_interrupt=None):
-        super().__init__(result_sink=result_sink, worker_count=worker_count, conn_timeout=conn_timeout,
-                         interface_uri=interface_uri, local_ip4=local_ip4, local_ip6=local_ip6,
-                         qof_port=qof_port, check_interrupt=check_interrupt)
+    flow_port = 80
+
+    def __init__(self, *args, http_probe='client', **kwargs):
+        """
+        With ``http_probe='client'``, the request is made and the response
+        parsed by :mod:`http.client`. With ``http_probe='raw'``, a prebuilt
+        request is written to the socket, and only the status line of the
+        response is read, up to ``HTTP_READ_BUDGET`` bytes.
+        """
+        if http_probe not in ('client', 'raw'):
+            raise ValueError("Unknown HTTP probe '{}'.".format(http_probe))
+
+        super().__init__(*args, **kwargs)
+        self.http_probe = http_probe
 
     def connect(self, job, pcs, config):
+        return self.http_connection(job, super().connect(job, pcs, config))
+
+    def finish_connect(self, job, pcs, config, sock, err):
+        return self.http_connection(job, super().finish_connect(job, pcs, config, sock, err))
+
+    def http_connection(self, job, conn):
+        """
+        Wrap the socket of a connection in an HTTPConnection.
+        """
+        if conn.state != CONN_OK:
+            conn.client.close()
+            self.release_port(conn.port)
+            return Connection(None, None, conn.state)
+
+        if self.http_probe == 'raw':
+            return conn
+
         client = http.client.HTTPConnection(str(job.ip), timeout=self.conn_timeout)
         client.auto_open = 0
-        try:
-            client.connect()
-        except socket.timeout:
-            return Connection(None, None, CONN_TIMEOUT)
-        except OSError as e:
-            return Connection(None, None, CONN_FAILED)
-        else:
-            return Connection(client, client.sock.getsockname()[1], CONN_OK)
+        client.sock = conn.client
+        return Connection(client, conn.port, CONN_OK)
+
+    def http_status(self, job, sock):
+        """
+        Request / from a connected socket and return the status code of the
+        response, or 0 if no status line arrived within the read budget.
+        """
+        sock.sendall(HTTP_REQUEST_HEAD + job.host.encode('latin-1') + HTTP_REQUEST_TAIL)
+
+        buf = b''
+        while b'\n' not in buf and len(buf) < HTTP_READ_BUDGET:
+            data = sock.recv(HTTP_READ_BUDGET - len(buf))
+            if not data:
+                break
+            buf += data
+
+        parts = buf.split(b'\n', 1)[0].split(None, 2)
+        if len(parts) >= 2 and parts[0].startswith(b'HTTP/') and len(parts[1]) == 3 and parts[1].isdigit():
+            return int(parts[1])
+        return 0
 
     def post_connect(self, job, conn, pcs, config):
-        if conn.state == CONN_OK:
+        if conn.state == CONN_OK and self.http_probe == 'raw':
+            try:
+                status = self.http_status(job, conn.client)
+            except (OSError, UnicodeError):
+                status = 0
+            finally:
+                conn.client.close()
+                self.release_port(conn.port)
+
+            return self.spider_record(job, conn, pcs, config, httpstatus=status)
+        elif conn.state == CONN_OK:
             headers = {'User-Agent': USER_AGENT,
                        'Connection': 'close',
                        'Host': job.host}
@@ -272,27 +749,60 @@ class EcnSpider2Http(EcnSpider2):
                 res = conn.client.getresponse()
                 conn.client.close()
 
-                return SpiderRecord(job.ip, job.host, conn.port, job.rport, config, True, res.status, None)
+                return self.spider_record(job, conn, pcs, config, httpstatus=res.status)
             except:
-                return SpiderRecord(job.ip, job.host, conn.port, job.rport, config, True, 0, None)
+                return self.spider_record(job, conn, pcs, config)
             finally:
                 conn.client.close()
+                self.release_port(conn.port)
         else:
-            return SpiderRecord(job.ip, job.host, 0, job.rport, config, False, 0, None)
+            return self.spider_record(job, conn, pcs, config, port=0)
+
+def tls_context():
+    """
+    Return the SSL context shared by all TLS spiders. Certificates are not
+    verified: only whether the handshake completes is of interest.
+    """
+    global _tls_context
+    if _tls_context is None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        _tls_context = context
+    return _tls_context
+
+_tls_context = None
+
+class EcnSpider2Tls(EcnSpider2):
+    """
+    Measures targets on port 443 and attempts a TLS handshake over each
+    connection, with the job's host name as SNI. The ``tls`` field of the
+    record says whether the handshake completed.
+    """
+    flow_port = 443
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tls_context = tls_context()
 
-    def ignore_flow(self, flow):
-        # Short-circuit non-HTTP over TCP flows, and reset storms
+    def post_connect(self, job, conn, pcs, config):
+        if conn.state != CONN_OK:
+            return super().post_connect(job, conn, pcs, config)
+
+        handshake = False
         try:
-            if flow["protocolIdentifier"] != 6:
-                return True
-            if flow["destinationTransportPort"] != 80:
-                return True
-            if flow["initialTCPFlags"] & TCP_RST:
-                return True
-        except:
-            return True
+            tls = self.tls_context.wrap_socket(conn.client,
+                    server_hostname=job.host or None, do_handshake_on_connect=False)
+            tls.do_handshake()
+            handshake = True
+            tls.close()
+        except (OSError, ValueError):
+            pass
+        finally:
+            conn.client.close()
+            self.release_port(conn.port)
 
-        return False
+        return self.spider_record(job, conn, pcs, config, tls=handshake)
 
 class EcnSpider2ConfigLinux:
     def __init__(self):
@@ -306,6 +816,88 @@ class EcnSpider2ConfigLinux:
         subprocess.check_call(['sudo', '-n', '/sbin/sysctl', '-w', 'net.ipv4.tcp_ecn=1'],
                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
+    def close(self):
+        pass
+
+def check_helper(helper):
+    """
+    Make sure only root can change the sysctl helper, since it is run as
+    root: the script and every directory above it must be owned by root
+    and not writable by group or others.
+    """
+    path = os.path.realpath(helper)
+    while True:
+        st = os.stat(path)
+        if st.st_uid != 0 or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise OSError("sysctl helper {} is not safe to run as root: {} may be changed by others than root".format(helper, path))
+
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        path = parent
+
+class EcnSpider2ConfigLinuxProc:
+    """
+    Sets net.ipv4.tcp_ecn by writing to a handle on /proc/sys/net/ipv4/tcp_ecn
+    which is held open for the lifetime of the spider, instead of running
+    sudo sysctl for every flip.
+
+    If the spider may write the sysctl itself (root or CAP_NET_ADMIN), the
+    handle is held in-process. Otherwise the handle is held by the helper
+    script ``helper``, started once through sudo and whitelisted for that in
+    sudoers; passing the file descriptor back would not help, as the kernel
+    checks sysctl permissions on every write.
+    """
+    def __init__(self, path=PROC_TCP_ECN, helper=PROC_HELPER):
+        self.fd = None
+        self.helper = None
+
+        try:
+            self.fd = os.open(path, os.O_RDWR)
+            # write back the current value to make sure we are allowed to
+            os.pwrite(self.fd, os.pread(self.fd, 16, 0), 0)
+        except PermissionError:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+            check_helper(helper)
+            self.helper = subprocess.Popen(['sudo', '-n', helper],
+                                           stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+            # the helper answers once it holds the sysctl open
+            reply = self.helper.stdout.readline()
+            if reply != b'ready\n':
+                self.close()
+                raise OSError("sysctl helper {} did not start: {}".format(helper, reply.decode().strip() or "helper exited"))
+
+    def write(self, value):
+        if self.fd is not None:
+            os.pwrite(self.fd, value, 0)
+            return
+
+        self.helper.stdin.write(value)
+        self.helper.stdin.flush()
+        reply = self.helper.stdout.readline()
+        if reply != b'ok\n':
+            raise OSError("sysctl helper failed to write {}: {}".format(PROC_TCP_ECN, reply.decode().strip() or "helper exited"))
+
+    def config_zero(self):
+        self.write(b'2\n')
+
+    def config_one(self):
+        self.write(b'1\n')
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+        if self.helper is not None:
+            self.helper.stdin.close()
+            self.helper.wait()
+            self.helper = None
+
 class EcnSpider2ConfigDarwin:
     def __init__(self):
         pass
@@ -318,3 +910,6 @@ class EcnSpider2ConfigDarwin:
         subprocess.check_call(['sudo', '-n', '/usr/sbin/sysctl', '-w', 'net.inet.tcp.ecn_initiate_out=1'],
                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
+    def close(self):
+        pass
+
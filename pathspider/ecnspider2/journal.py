@@ -0,0 +1,171 @@
+"""
+Ecnspider2: Qofspider-based tool for measuring ECN-linked connectivity
+Derived from ECN Spider (c) 2014 Damiano Boppart <hat.guy.repo@gmail.com>
+
+Checkpoint journal: records merged records of a measurement on disk as
+they arrive, so that a measurement which is interrupted, or whose probe
+is restarted, can be resumed without measuring completed targets again.
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+
+from ipaddress import ip_address
+import collections
+import threading
+import hashlib
+import marshal
+import logging
+import os
+
+from .ecnspider import MergedRecord, EARLY_SKIP
+
+# first entry of every journal file
+JOURNAL_MAGIC = ('ecnspider-journal', 1)
+
+# records written between flushes to disk
+JOURNAL_FLUSH = 1000
+
+def journal_name(spec):
+    """
+    Return the file name of the journal for a specification: a digest of
+    its label and parameter values, so that the same measurement invoked
+    again finds the journal of the previous attempt.
+    """
+    digest = hashlib.sha1(spec.get_label().encode())
+    for name in sorted(spec.parameter_names()):
+        digest.update(name.encode())
+        digest.update(repr(spec.get_parameter_value(name)).encode())
+    return digest.hexdigest() + '.journal'
+
+class Journal:
+    """
+    Append-only file of the merged records of one measurement.
+
+    Records are passed on to ``store`` as they are appended, so a journal
+    can stand in for a record store as result sink. Entries are marshalled
+    tuples, one per record, with the address packed; a truncated last
+    entry, as left by a crash, is ignored on load.
+
+    Results which were still waiting for their flow when the spider was
+    stopped arrive as records without flow data, as for any unmatched
+    result. Such a record does not settle its target (see :meth:`settled`),
+    so the target is measured again on resume. Jobs not measured yet are
+    not written: on resume, they are the jobs of the specification whose
+    target has no settled pair of records in the journal.
+    """
+
+    def __init__(self, path, store):
+        self.path = path
+        self.store = store
+        self.lock = threading.Lock()
+        self.completed = set()
+        self.unflushed = 0
+        self.file = None
+
+    @staticmethod
+    def target(rec):
+        return (rec.ip, rec.rport, rec.host)
+
+    @staticmethod
+    def settled(rec):
+        """
+        Return True if a record is final: it was merged with its flow, or
+        it could not have one, because no connect was made or it never got
+        a source port (see :meth:`EcnSpider2.expects_flow`). Records which
+        lack their flow otherwise may have been flushed when the spider
+        was interrupted.
+        """
+        return rec.fif is not None or rec.port in (0, None) or rec.early == EARLY_SKIP
+
+    def load(self):
+        """
+        Read the records of a previous attempt, pass the records of
+        completed targets to the store, and open the journal for appending.
+
+        :returns: the number of records restored.
+        """
+        logger = logging.getLogger('ecnspider')
+
+        records = []
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                try:
+                    if marshal.load(f) != JOURNAL_MAGIC:
+                        raise ValueError("not an ecnspider journal")
+                    while True:
+                        entry = marshal.load(f)
+                        records.append(MergedRecord(ip_address(entry[0]), *entry[1:]))
+                except EOFError:
+                    pass
+                except (ValueError, TypeError) as e:
+                    logger.warning("journal {} is damaged after {} records: {}".format(self.path, len(records), e))
+
+        # a target is complete once both of its records are in and settled
+        states = collections.defaultdict(set)
+        for rec in records:
+            if self.settled(rec):
+                states[self.target(rec)].add(rec.ecnstate)
+        self.completed = {target for target, ecnstates in states.items() if len(ecnstates) == 2}
+
+        # rewrite the journal without records of incomplete targets
+        restored = [rec for rec in records if self.target(rec) in self.completed]
+        self.file = open(self.path + '.tmp', 'wb')
+        marshal.dump(JOURNAL_MAGIC, self.file)
+        for rec in restored:
+            self.write(rec)
+            self.store.append(rec)
+        self.file.flush()
+        os.replace(self.path + '.tmp', self.path)
+
+        if len(restored) > 0:
+            logger.info("resuming from journal {}: {} targets complete".format(self.path, len(self.completed)))
+        return len(restored)
+
+    def pending(self, jobs):
+        """Yield the jobs whose target is not complete in the journal."""
+        for job in jobs:
+            if (job.ip, job.rport, job.host) not in self.completed:
+                yield job
+
+    def write(self, rec):
+        marshal.dump((rec.ip.packed,) + tuple(rec[1:]), self.file)
+
+    def append(self, rec):
+        rec = rec._replace(userval=None)
+        with self.lock:
+            self.write(rec)
+            self.unflushed += 1
+            if self.unflushed >= JOURNAL_FLUSH:
+                self.file.flush()
+                self.unflushed = 0
+
+        self.store.append(rec)
+
+    def close(self, remove=False):
+        """
+        Flush and close the journal. With ``remove``, the measurement is
+        complete and the journal is deleted.
+        """
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+        if remove:
+            os.remove(self.path)
@@ -24,21 +24,27 @@ Derived and generalized from ECN Spider
 
 """
 
-from collections import namedtuple
-from ipaddress import ip_address
+from collections import namedtuple, OrderedDict, Counter, deque
+from ipaddress import ip_address, ip_network
 import tempfile
 import subprocess
 import threading
 import socketserver
 import queue
 import ipfix.reader
+import ipfix.template
 import ipfix
+import struct
 import yaml
 import sys
 import os
 import time
 import logging
 import socket
+import selectors
+import heapq
+import errno
+import concurrent.futures
 
 ###
 ### Utility Classes
@@ -87,12 +93,611 @@ class SemaphoreN(threading.BoundedSemaphore):
         while self.acquire(blocking=False):
             pass
 
+class SignalQueue(queue.Queue):
+    """
+    A Queue which sets an Event whenever an item is put into it, so that a
+    single consumer can block on several queues at once, and which can hand
+    out and mark done its items in bulk.
+    """
+    def __init__(self, maxsize, event):
+        super().__init__(maxsize)
+        self.event = event
+
+    def _put(self, item):
+        super()._put(item)
+        self.event.set()
+
+    def get_all(self, limit):
+        """
+        Remove and return up to ``limit`` items without blocking.
+        """
+        with self.mutex:
+            items = [self._get() for _ in range(min(self._qsize(), limit))]
+            if len(items) > 0:
+                self.not_full.notify(len(items))
+            return items
+
+    def task_done_n(self, value):
+        """
+        Indicate that ``value`` formerly enqueued tasks are complete.
+        """
+        with self.all_tasks_done:
+            unfinished = self.unfinished_tasks - value
+            if unfinished < 0:
+                raise ValueError('task_done_n() called too many times')
+            if unfinished == 0:
+                self.all_tasks_done.notify_all()
+            self.unfinished_tasks = unfinished
+
+class JobQueue:
+    """
+    A queue of jobs split into ``shards`` bounded queues. Each job is put
+    into the shard ``shard_of`` returns for it, and each worker takes jobs
+    from its own shard only, so that every shard is served by its own
+    subset of workers. Towards producers, and for :meth:`join`, the shards
+    behave like a single :class:`queue.Queue` of ``maxsize`` jobs.
+    """
+    def __init__(self, maxsize, shards=1, shard_of=None):
+        self.queues = [queue.Queue(-(-maxsize // shards)) for _ in range(shards)]
+        self.shard_of = shard_of
+
+    def shard(self, job):
+        if len(self.queues) == 1:
+            return 0
+        return self.shard_of(job) % len(self.queues)
+
+    def put(self, job, timeout=None):
+        self.queues[self.shard(job)].put(job, timeout=timeout)
+
+    def get(self, shard=0, timeout=None):
+        return self.queues[shard].get(timeout=timeout)
+
+    def get_nowait(self, shard=0):
+        return self.queues[shard].get_nowait()
+
+    def task_done(self, job):
+        self.queues[self.shard(job)].task_done()
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def join(self):
+        for q in self.queues:
+            q.join()
+
+    def clear(self):
+        """
+        Drop all queued jobs.
+
+        :returns: the number of jobs dropped.
+        """
+        dropped = 0
+        for q in self.queues:
+            try:
+                while True:
+                    q.get_nowait()
+                    q.task_done()
+                    dropped += 1
+            except queue.Empty:
+                pass
+        return dropped
+
+    def abandon(self):
+        """
+        Mark all unfinished jobs done, so that :meth:`join` returns.
+        """
+        for q in self.queues:
+            try:
+                while True:
+                    q.task_done()
+            except ValueError:
+                pass
+
+class ConnectLoop:
+    """
+    Drives a large number of non-blocking connects from a single thread.
+
+    The loop uses the spider's :meth:`QofSpider.start_connect` and
+    :meth:`QofSpider.finish_connect` hooks, so the connection objects it
+    returns are the same ones the spider's :meth:`QofSpider.post_connect`
+    expects from :meth:`QofSpider.connect`.
+    """
+    def __init__(self, spider):
+        self.spider = spider
+        self.selector = selectors.DefaultSelector()
+
+    def connect_all(self, tasks, deadline=None):
+        """
+        Start a connect for every ``(job, pcs, config)`` tuple in ``tasks`` at
+        once, and wait until each of them has either completed or timed out.
+
+        :param deadline: optional absolute :func:`time.monotonic` value after
+                         which all pending connects are treated as timed out.
+        :returns: a list of connection objects in the order of ``tasks``.
+        """
+        spider = self.spider
+        conns = [None] * len(tasks)
+        timeouts = []
+        pending = 0
+
+        for i, (job, pcs, config) in enumerate(tasks):
+            conn = spider.skip_connect(job, pcs, config)
+            if conn is not None:
+                conns[i] = conn
+                continue
+
+            sock, err = spider.start_connect(job, pcs, config)
+            if err not in (0, errno.EINPROGRESS):
+                conns[i] = spider.finish_connect(job, pcs, config, sock, err)
+                continue
+
+            expires = time.monotonic() + spider.connect_timeout(job, pcs, config)
+            if deadline is not None:
+                expires = min(expires, deadline)
+
+            self.selector.register(sock, selectors.EVENT_WRITE, i)
+            heapq.heappush(timeouts, (expires, i, sock))
+            pending += 1
+
+        while pending > 0:
+            # expire connects which ran out of time
+            now = time.monotonic()
+            while len(timeouts) > 0 and timeouts[0][0] <= now:
+                _, i, sock = heapq.heappop(timeouts)
+                if conns[i] is None:
+                    self.selector.unregister(sock)
+                    job, pcs, config = tasks[i]
+                    conns[i] = spider.finish_connect(job, pcs, config, sock, None)
+                    pending -= 1
+
+            if pending == 0:
+                break
+
+            # wait for completed connects
+            for key, _ in self.selector.select(timeouts[0][0] - now):
+                i = key.data
+                sock = key.fileobj
+                self.selector.unregister(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                job, pcs, config = tasks[i]
+                conns[i] = spider.finish_connect(job, pcs, config, sock, err)
+                pending -= 1
+
+        return conns
+
+    def close(self):
+        self.selector.close()
+
+class Phase:
+    """
+    A batch of connects performed under one system configuration.
+
+    Tasks are completed by any number of workers; the phase scheduler waits
+    until all of them are complete or the phase deadline has passed.
+    """
+    def __init__(self, tasks, deadline=None):
+        self.tasks = tasks
+        self.conns = [None] * len(tasks)
+        self.deadline = deadline
+        self.remaining = len(tasks)
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def complete(self, i, conn):
+        """
+        Store the connection object for task ``i``.
+
+        :returns: False if the phase has already been closed, in which case
+                  the connection was made under an unknown configuration.
+        """
+        with self.cond:
+            if self.closed:
+                return False
+
+            self.conns[i] = conn
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.cond.notify_all()
+            return True
+
+    def wait(self, timeout=None):
+        """
+        Wait for all tasks to complete or the deadline to pass, and close
+        the phase if either happened.
+
+        :returns: True if the phase is closed, False if ``timeout`` expired first.
+        """
+        with self.cond:
+            if self.remaining > 0:
+                if self.deadline is not None:
+                    remaining_time = self.deadline - time.monotonic()
+                    if timeout is None or remaining_time < timeout:
+                        timeout = max(remaining_time, 0)
+                self.cond.wait(timeout)
+
+            if self.remaining == 0 or (self.deadline is not None and time.monotonic() >= self.deadline):
+                self.closed = True
+
+            return self.closed
+
+class PortPool:
+    """
+    Hands out local source ports from a fixed range.
+
+    Released ports are quarantined for ``quarantine`` seconds before they
+    are handed out again, so the kernel and QoF are done with the previous
+    connection. Every allocation of a port increases its generation; the
+    time of the last few allocations is kept, so that a flow can be mapped
+    back to the generation of the connection it belongs to by its start
+    time, even when it arrives after the port was reused.
+
+    The range can be split into ``shards`` disjoint slices, e.g. one per
+    source address, which ports are acquired from separately.
+    """
+
+    def __init__(self, first, last, quarantine=None, shards=1):
+        if last - first + 1 < shards:
+            raise ValueError("Port range {}-{} is too small for {} shards.".format(first, last, shards))
+
+        self.first = first
+        self.last = last
+        self.quarantine = PORT_QUARANTINE if quarantine is None else quarantine
+        self.shard_size = (last - first + 1) // shards
+        self.free = [deque() for _ in range(shards)]
+        for port in range(first, last + 1):
+            self.free[self.shard(port)].append(port)
+        self.quarantined = deque()
+        self.generations = [0] * (last - first + 1)
+        self.history = [deque(maxlen=PORT_HISTORY) for _ in range(last - first + 1)]
+        self.exhausted = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, port):
+        return self.first <= port <= self.last
+
+    def shard(self, port):
+        return min((port - self.first) // self.shard_size, len(self.free) - 1)
+
+    def acquire(self, shard=0):
+        """
+        :returns: a free port of ``shard``, or None if all its ports are in
+                  use or quarantined.
+        """
+        with self.lock:
+            now = time.monotonic()
+            while len(self.quarantined) > 0 and self.quarantined[0][0] <= now:
+                port = self.quarantined.popleft()[1]
+                self.free[self.shard(port)].append(port)
+
+            free = self.free[shard]
+            if len(free) == 0:
+                self.exhausted += 1
+                return None
+
+            port = free.popleft()
+            i = port - self.first
+            self.generations[i] += 1
+            self.history[i].append((time.time(), self.generations[i]))
+            return port
+
+    def release(self, port):
+        if port is None or port not in self:
+            return
+
+        with self.lock:
+            self.quarantined.append((time.monotonic() + self.quarantine, port))
+
+    def generation(self, port):
+        """
+        :returns: the generation of the current allocation of port, or 0 for
+                  ports outside the pool.
+        """
+        if port is None or port not in self:
+            return 0
+        return self.generations[port - self.first]
+
+    def generation_at(self, port, start):
+        """
+        :returns: the generation of port which was allocated when a flow
+                  starting at ``start`` (seconds since the epoch) began, or
+                  0 for ports outside the pool.
+        """
+        if port not in self:
+            return 0
+
+        # successive allocations are at least a quarantine apart
+        slack = min(PORT_CLOCK_SLACK, self.quarantine / 2)
+
+        generation = 0
+        with self.lock:
+            for stamp, gen in self.history[port - self.first]:
+                if stamp <= start + slack:
+                    generation = gen
+        return generation
+
+class AdaptiveTimeout:
+    """
+    Connection timeout derived from the handshake times seen so far.
+
+    The timeout is ``multiplier`` times the ``percentile`` of the most
+    recent handshake times, bounded by ``floor`` and ``ceiling``; until
+    enough handshakes have completed, it is the ceiling. With
+    ``scope='prefix'``, handshake times are also kept per /24 (/48 for
+    IPv6), and targets in a prefix with enough samples of its own are
+    timed by those.
+
+    Time saved is the time connects which expired would have waited
+    longer under the fixed ``ceiling``.
+    """
+
+    def __init__(self, ceiling, floor=None, percentile=None, multiplier=None, scope='run'):
+        if scope not in ('run', 'prefix'):
+            raise ValueError("Unknown timeout scope '{}'.".format(scope))
+
+        self.ceiling = ceiling
+        self.floor = min(TIMEOUT_FLOOR if floor is None else floor, ceiling)
+        self.percentile = TIMEOUT_PERCENTILE if percentile is None else percentile
+        self.multiplier = TIMEOUT_MULTIPLIER if multiplier is None else multiplier
+        self.scope = scope
+
+        self.samples = deque(maxlen=TIMEOUT_SAMPLES)
+        self.prefixes = OrderedDict()
+        self.current = None
+        self.added = 0
+
+        self.expired_count = 0
+        self.saved = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def prefix(ip):
+        return (ip.version, int(ip) >> (8 if ip.version == 4 else 80))
+
+    def quantile(self, window):
+        values = sorted(window)
+        return values[min(len(values) - 1, int(len(values) * self.percentile / 100))]
+
+    def bound(self, rtt):
+        return min(max(rtt * self.multiplier, self.floor), self.ceiling)
+
+    def timeout(self, ip):
+        """
+        :returns: the connect timeout in seconds for a target at ip.
+        """
+        with self.lock:
+            if self.scope == 'prefix':
+                window = self.prefixes.get(self.prefix(ip))
+                if window is not None and len(window) >= TIMEOUT_PREFIX_MIN:
+                    return self.bound(self.quantile(window))
+
+            if len(self.samples) < TIMEOUT_MIN_SAMPLES:
+                return self.ceiling
+
+            if self.current is None:
+                self.current = self.bound(self.quantile(self.samples))
+            return self.current
+
+    def handshake(self, ip, rtt):
+        """Record a connect to ip which completed after rtt seconds."""
+        with self.lock:
+            self.samples.append(rtt)
+            self.added += 1
+            if self.added % TIMEOUT_UPDATE == 0:
+                self.current = None
+
+            if self.scope == 'prefix':
+                key = self.prefix(ip)
+                window = self.prefixes.get(key)
+                if window is None:
+                    if len(self.prefixes) >= TIMEOUT_PREFIXES:
+                        self.prefixes.popitem(last=False)
+                    window = self.prefixes[key] = deque(maxlen=TIMEOUT_PREFIX_SAMPLES)
+                window.append(rtt)
+
+    def expired(self, waited):
+        """Record a connect which timed out after waiting for waited seconds."""
+        with self.lock:
+            self.expired_count += 1
+            self.saved += max(self.ceiling - waited, 0.0)
+
+    def stats(self):
+        """
+        :returns: a dict with the current timeout, the number of handshakes
+                  and expired connects seen, and the seconds saved.
+        """
+        with self.lock:
+            current = self.current
+            if current is None and len(self.samples) >= TIMEOUT_MIN_SAMPLES:
+                current = self.bound(self.quantile(self.samples))
+
+            return {'timeout': current if current is not None else self.ceiling,
+                    'handshakes': self.added,
+                    'expired': self.expired_count,
+                    'saved': self.saved}
+
+class SourceSet:
+    """
+    The local addresses and prefixes measurement flows originate from.
+
+    Membership is tested on packed addresses, as they appear in IPFIX
+    records, so flows can be filtered before anything is decoded.
+    """
+
+    def __init__(self, sources):
+        self.addresses = set()
+        self.prefixes = []
+        for source in sources:
+            if source is None:
+                continue
+            net = ip_network(source, strict=False)
+            if net.num_addresses == 1:
+                self.addresses.add(net.network_address.packed)
+            else:
+                self.prefixes.append((net.max_prefixlen // 8,
+                                      int(net.network_address), int(net.netmask)))
+
+    def __repr__(self):
+        return "<SourceSet {} addresses {} prefixes>".format(
+                len(self.addresses), len(self.prefixes))
+
+    def contains_packed(self, packed):
+        if packed in self.addresses:
+            return True
+
+        if self.prefixes:
+            value = int.from_bytes(packed, 'big')
+            for length, network, netmask in self.prefixes:
+                if length == len(packed) and value & netmask == network:
+                    return True
+
+        return False
+
+    def __contains__(self, addr):
+        return self.contains_packed(addr.packed)
+
+    def has_version(self, version):
+        """True if any address or prefix is of the given IP version."""
+        length = 4 if version == 4 else 16
+        return (any(len(a) == length for a in self.addresses) or
+                any(p[0] == length for p in self.prefixes))
+
+class FlowReader:
+    """
+    Reads flow records from a stream of IPFIX messages, decoding data sets
+    with a struct compiled once per template.
+
+    For each template, ``compile_fn(tmpl)`` returns a ``(struct, convert)``
+    pair, where ``struct`` unpacks a whole record and ``convert`` turns the
+    unpacked values into a flow record or None, or returns None if it cannot
+    handle the template. Records of such templates are decoded generically
+    and passed to ``fallback_fn`` as a dict.
+    """
+
+    def __init__(self, compile_fn, fallback_fn):
+        self.compile_fn = compile_fn
+        self.fallback_fn = fallback_fn
+        self.templates = {}
+        self.compiled = {}
+        self.msgcount = 0
+
+    def read_message(self, stream):
+        """
+        :returns: the message as a memoryview and its observation domain,
+                  or None at the end of the stream.
+        """
+        hdr = stream.read(MSGHDR_ST.size)
+        if len(hdr) == 0:
+            return None
+        elif len(hdr) < MSGHDR_ST.size:
+            raise ipfix.template.IpfixDecodeError("Short read in message header")
+
+        (version, length, export_time, sequence, odid) = MSGHDR_ST.unpack(hdr)
+        if version != 10 or length < MSGHDR_ST.size:
+            raise ipfix.template.IpfixDecodeError("Illegal message header")
+
+        body = stream.read(length - MSGHDR_ST.size)
+        if len(body) < length - MSGHDR_ST.size:
+            raise ipfix.template.IpfixDecodeError("Short read in message body")
+
+        self.msgcount += 1
+        return (memoryview(body), odid)
+
+    def add_template(self, key, tmpl):
+        if tmpl.count() == 0:
+            # template withdrawal
+            self.templates.pop(key, None)
+            self.compiled.pop(key, None)
+            return
+
+        self.templates[key] = tmpl
+        compiled = None
+        if tmpl.varlenslice is None:
+            compiled = self.compile_fn(tmpl)
+        self.compiled[key] = compiled
+
+    def records(self, buf, odid):
+        """Iterate over the flow records in the body of one message."""
+        offset = 0
+        while offset + SETHDR_ST.size <= len(buf):
+            (setid, setlen) = SETHDR_ST.unpack_from(buf, offset)
+            if setlen < SETHDR_ST.size or offset + setlen > len(buf):
+                raise ipfix.template.IpfixDecodeError("Set too long for message")
+            setend = offset + setlen
+            offset += SETHDR_ST.size
+
+            if setid == ipfix.template.TEMPLATE_SET_ID or setid == ipfix.template.OPTIONS_SET_ID:
+                while offset + SETHDR_ST.size <= setend:
+                    (tmpl, offset) = ipfix.template.decode_template_from(buf, offset, setid)
+                    self.add_template((odid, tmpl.tid), tmpl)
+            elif (odid, setid) in self.templates:
+                compiled = self.compiled[(odid, setid)]
+                if compiled is not None:
+                    (st, convert) = compiled
+                    count = (setend - offset) // st.size
+                    for values in st.iter_unpack(buf[offset:offset + count * st.size]):
+                        rec = convert(values)
+                        if rec is not None:
+                            yield rec
+                else:
+                    tmpl = self.templates[(odid, setid)]
+                    while offset + tmpl.minlength <= setend:
+                        (flow, offset) = tmpl.decode_namedict_from(buf, offset)
+                        rec = self.fallback_fn(flow)
+                        if rec is not None:
+                            yield rec
+
+            offset = setend
+
+    def iterator(self, stream):
+        """Iterate over all flow records in the stream."""
+        while True:
+            msg = self.read_message(stream)
+            if msg is None:
+                return
+            yield from self.records(*msg)
+
 QUEUE_SIZE = 1000
 QUEUE_SLEEP = 0.5
 
+# max num of jobs queued for the workers, from add_job or add_jobs
+JOB_BACKLOG = 10000
+
+ENGINE_THREADS = 4
+ENGINE_POST_WORKERS = 32
+
+PHASE_DEADLINE = None
+
+MERGE_BATCH = 1000
+MERGE_STATS_INTERVAL = 10
+
+TABLE_TTL = 300
+TABLE_SIZE = 1000000
+
 QOF_INITIAL_SLEEP = 3
 QOF_FINAL_SLEEP = 3
 
+# source port pool: seconds a released port rests, allocations remembered
+# per port, and tolerance between our clock and flow start times
+PORT_QUARANTINE = 120
+PORT_HISTORY = 4
+PORT_CLOCK_SLACK = 1
+
+# adaptive connect timeout: handshake times kept, run-wide and per prefix,
+# samples needed before they are used, and handshakes between updates
+TIMEOUT_FLOOR = 1.0
+TIMEOUT_PERCENTILE = 95
+TIMEOUT_MULTIPLIER = 3
+TIMEOUT_SAMPLES = 1000
+TIMEOUT_MIN_SAMPLES = 50
+TIMEOUT_UPDATE = 100
+TIMEOUT_PREFIXES = 65536
+TIMEOUT_PREFIX_SAMPLES = 32
+TIMEOUT_PREFIX_MIN = 8
+
+# IPFIX message and set headers
+MSGHDR_ST = struct.Struct("!HHLLL")
+SETHDR_ST = struct.Struct("!HH")
+
 class QofSpider:
     """
     A spider consists of a configurator (which alternates between two
@@ -101,9 +706,53 @@ class QofSpider:
     around QoF, and a thread that merges results from the workers
     with flow records from the collector.
 
+    Workers are run by one of two engines: the 'thread' engine starts
+    one thread per worker, each performing a blocking connect, while the
+    'event' engine drives ``worker_count`` concurrent non-blocking
+    connects from ``engine_threads`` threads using a selector.
+
+    With the 'semaphore' scheduler, the configurator flips the configuration
+    once per round and every worker hands its tokens back before the next
+    flip. With the 'phase' scheduler, a single thread collects a batch of up
+    to ``phase_batch`` jobs, runs every configuration zero connect of the
+    batch at once, flips the configuration, and runs every configuration one
+    connect. A phase ends when all of its connects are done, or after
+    ``phase_deadline`` seconds.
+
+    If the spider can apply both configurations per connection
+    (``concurrent_configs``), the configuration is never flipped: the
+    semaphores are bypassed and both connects for a job run at once.
+
+    Flows and results which find no partner are kept for at most
+    ``table_ttl`` seconds, and at most ``table_size`` of each are kept.
+    Unmatched results which are evicted, or left over when the spider
+    stops, are passed to :meth:`unmatched`.
+
+    The IPFIX collector either decodes every flow into a dict and passes it
+    to :meth:`tupleize_flow` ('dict'), or decodes records with structs
+    compiled per template by :meth:`compile_tupleizer` ('compiled').
+
+    Jobs can be added one by one with :meth:`add_job`, or as an iterable
+    with :meth:`add_jobs`, which a feeder thread consumes lazily. At most
+    ``JOB_BACKLOG`` jobs are queued; :meth:`add_job` blocks while the
+    queue is full.
+
+    While there are no jobs, the spider is idle: the configurator does not
+    flip the configuration, and the workers block until a job arrives.
+
+    With the 'semaphore' scheduler, jobs can be split into up to
+    ``job_shards`` shards by :meth:`job_shard`, each served by its own
+    subset of the worker threads (or engine threads). The 'phase'
+    scheduler takes its batches from a single queue.
+
     """
 
-    def __init__(self, worker_count, interface_uri, qof_port=4739, check_interrupt=None):
+    def __init__(self, worker_count, interface_uri, qof_port=4739, check_interrupt=None,
+                 engine='thread', engine_threads=ENGINE_THREADS,
+                 scheduler='semaphore', phase_batch=None, phase_deadline=PHASE_DEADLINE,
+                 concurrent_configs=False,
+                 table_ttl=TABLE_TTL, table_size=TABLE_SIZE,
+                 collector='dict', job_shards=1):
         self.running = False
         self.stopping = False
         self.terminating = False
@@ -114,26 +763,67 @@ class QofSpider:
         self.interface_uri = interface_uri
         self.qof_port = qof_port
 
-        self.sem_config_zero = SemaphoreN(worker_count)
+        if engine == 'thread':
+            self.sync_count = worker_count
+        elif engine == 'event':
+            self.engine_threads = min(engine_threads, worker_count)
+            self.sync_count = self.engine_threads
+        else:
+            raise ValueError("Unknown worker engine '{}'.".format(engine))
+        self.engine = engine
+        self.post_executor = None
+
+        if scheduler not in ('semaphore', 'phase'):
+            raise ValueError("Unknown scheduler '{}'.".format(scheduler))
+        self.scheduler = scheduler
+        self.phase_batch = phase_batch or worker_count
+        self.phase_deadline = phase_deadline
+        self.phasequeue = queue.Queue()
+
+        self.concurrent_configs = concurrent_configs
+
+        self.sem_config_zero = SemaphoreN(self.sync_count)
         self.sem_config_zero.empty()
-        self.sem_config_zero_rdy = SemaphoreN(worker_count)
+        self.sem_config_zero_rdy = SemaphoreN(self.sync_count)
         self.sem_config_zero_rdy.empty()
-        self.sem_config_one = SemaphoreN(worker_count)
+        self.sem_config_one = SemaphoreN(self.sync_count)
         self.sem_config_one.empty()
-        self.sem_config_one_rdy = SemaphoreN(worker_count)
+        self.sem_config_one_rdy = SemaphoreN(self.sync_count)
         self.sem_config_one_rdy.empty()
 
-        self.jobqueue = queue.Queue()
-        self.flowqueue = queue.Queue(QUEUE_SIZE)
-        self.resqueue =  queue.Queue(QUEUE_SIZE)
-
-        self.restab = {}
-        self.flowtab = {}
+        # every shard needs a worker thread of its own
+        if scheduler == 'phase':
+            job_shards = 1
+        self.job_shards = max(1, min(job_shards, self.sync_count))
+        self.jobqueue = JobQueue(JOB_BACKLOG, self.job_shards, self.job_shard)
+        self.job_sources = queue.Queue()
+        self.job_aborts = 0
+        self.job_arrival = threading.Event()
+        self.merge_wakeup = threading.Event()
+        self.flowqueue = SignalQueue(QUEUE_SIZE, self.merge_wakeup)
+        self.resqueue =  SignalQueue(QUEUE_SIZE, self.merge_wakeup)
+
+        # unmatched results and flows, as (time, record) in arrival order
+        self.restab = OrderedDict()
+        self.flowtab = OrderedDict()
+        self.table_ttl = table_ttl
+        self.table_size = table_size
+
+        if collector not in ('dict', 'compiled'):
+            raise ValueError("Unknown collector '{}'.".format(collector))
+        self.collector = collector
+        self.evictions = Counter()
+
+        # merger statistics
+        self.merge_count = 0
+        self.merge_duplicates = 0
+        self.merge_rate = 0.0
 
         self.listener = None
         self.qofproc = None
 
         self.qofowner_thread = None
+        self.feeder_thread = None
         self.worker_threads = []
         self.qoflistener_thread = None
         self.configurator_thread = None
@@ -150,23 +840,231 @@ class QofSpider:
         """
         logger = logging.getLogger('qofspider')
 
-        while self.running:
+        while self.wait_for_jobs():
             logger.debug("setting config zero")
             self.config_zero()
             logger.debug("config zero active")
-            self.sem_config_zero.release_n(self.worker_count)
-            self.sem_config_one_rdy.acquire_n(self.worker_count)
+            self.sem_config_zero.release_n(self.sync_count)
+            self.sem_config_one_rdy.acquire_n(self.sync_count)
             logger.debug("setting config one")
             self.config_one()
             logger.debug("config one active")
-            self.sem_config_one.release_n(self.worker_count)
-            self.sem_config_zero_rdy.acquire_n(self.worker_count)
+            self.sem_config_one.release_n(self.sync_count)
+            self.sem_config_zero_rdy.acquire_n(self.sync_count)
 
         # In case the master exits the run loop before all workers have,
         # these tokens will allow all workers to run through again,
         # until the next check at the start of the loop
-        self.sem_config_zero.release_n(self.worker_count)
-        self.sem_config_one.release_n(self.worker_count)
+        self.sem_config_zero.release_n(self.sync_count)
+        self.sem_config_one.release_n(self.sync_count)
+
+    def wait_for_jobs(self):
+        """
+        Block while no job is queued.
+
+        :returns: False if the spider stopped running in the meantime.
+        """
+        logger = logging.getLogger('qofspider')
+
+        idle = False
+        while self.running:
+            if self.jobqueue.qsize() > 0:
+                if idle:
+                    logger.debug("jobs arrived, leaving idle state")
+                return True
+
+            if not idle:
+                logger.debug("no jobs, idle")
+                idle = True
+
+            self.job_arrival.clear()
+            if self.jobqueue.qsize() == 0:
+                self.job_arrival.wait()
+
+        return False
+
+    def join_round(self, limit, shard=0):
+        """
+        Wait for the configurator to start a round, and take up to
+        ``limit`` jobs queued in ``shard`` for it. The configurator only starts a round
+        once a job is queued, so idle workers block here. A worker which
+        finds no job left passes through the round at once.
+
+        :returns: the list of jobs taken. Unless it is empty, the caller
+                  holds configuration zero and has to finish the round.
+        """
+        self.sem_config_zero.acquire()
+
+        jobs = []
+        try:
+            while len(jobs) < limit:
+                jobs.append(self.jobqueue.get_nowait(shard))
+        except queue.Empty:
+            pass
+
+        if len(jobs) == 0:
+            self.sem_config_one_rdy.release()
+            self.sem_config_one.acquire()
+            self.sem_config_zero_rdy.release()
+
+        return jobs
+
+    def take_jobs(self, limit, shard=0):
+        """
+        Wait up to ``QUEUE_SLEEP`` seconds for a job, and take up to
+        ``limit`` jobs queued in ``shard``.
+
+        :returns: the list of jobs taken, empty if none arrived.
+        """
+        jobs = []
+        try:
+            jobs.append(self.jobqueue.get(shard, timeout=QUEUE_SLEEP))
+            while len(jobs) < limit:
+                jobs.append(self.jobqueue.get_nowait(shard))
+        except queue.Empty:
+            pass
+
+        return jobs
+
+    def next_jobs(self, limit, shard=0):
+        """
+        Take up to ``limit`` jobs from ``shard`` for the next round of a
+        worker. Unless
+        configurations run concurrently, the round is synchronized with
+        the configurator through :meth:`join_round`.
+        """
+        if self.concurrent_configs:
+            # nothing to synchronize with, just wait for a job
+            return self.take_jobs(limit, shard)
+        else:
+            return self.join_round(limit, shard)
+
+    def connect_round(self, jobs, connect_all):
+        """
+        Connect a round's jobs in both configurations. ``connect_all`` takes
+        a list of ``(job, pcs, config)`` tasks and returns their connection
+        objects in order. Unless configurations run concurrently, the caller
+        holds configuration zero, see :meth:`join_round`.
+
+        :returns: the lists of preconnection states and of connection
+                  objects for configuration zero and one.
+        """
+        # Hook for preconnection
+        pcss = [self.pre_connect(job) for job in jobs]
+        tasks0 = [(job, pcs, 0) for job, pcs in zip(jobs, pcss)]
+        tasks1 = [(job, pcs, 1) for job, pcs in zip(jobs, pcss)]
+
+        if self.concurrent_configs:
+            # Connect all jobs in both configurations at once
+            conns = connect_all(tasks0 + tasks1)
+            conns0, conns1 = conns[:len(jobs)], conns[len(jobs):]
+        else:
+            # Connect all jobs in configuration zero
+            conns0 = connect_all(tasks0)
+
+            # Wait for configuration one
+            self.sem_config_one_rdy.release()
+            self.sem_config_one.acquire()
+
+            # Connect all jobs in configuration one
+            conns1 = connect_all(tasks1)
+
+            # Signal okay to go to configuration zero
+            self.sem_config_zero_rdy.release()
+
+        return pcss, conns0, conns1
+
+    def submit_post_connect(self, jobs, pcss, conns0, conns1):
+        """
+        Pass the connections of a batch of jobs on for merge, running
+        post_connect on the thread pool.
+        """
+        for job, pcs, conn0, conn1 in zip(jobs, pcss, conns0, conns1):
+            self.post_executor.submit(self.exception_wrapper,
+                    lambda job=job, pcs=pcs, conn0=conn0, conn1=conn1:
+                        self.post_connect_job(job, pcs, conn0, conn1))
+
+    def queue_job(self, job, timeout=None):
+        self.jobqueue.put(job, timeout=timeout)
+        if not self.job_arrival.is_set():
+            self.job_arrival.set()
+
+    def phaser(self):
+        """
+        Thread which takes the role of the configurator for the 'phase'
+        scheduler. Collects batches of jobs and runs each configuration
+        for the whole batch at once.
+        """
+        logger = logging.getLogger('qofspider')
+
+        while self.running:
+            jobs = self.take_jobs(self.phase_batch)
+            if len(jobs) == 0:
+                continue
+
+            logger.debug("got a batch of {} jobs".format(len(jobs)))
+
+            # Hook for preconnection
+            pcss = [self.pre_connect(job) for job in jobs]
+            tasks0 = [(job, pcs, 0) for job, pcs in zip(jobs, pcss)]
+            tasks1 = [(job, pcs, 1) for job, pcs in zip(jobs, pcss)]
+
+            if self.concurrent_configs:
+                # both configurations in a single phase
+                conns = self.run_phase(tasks0 + tasks1)
+                conns0, conns1 = conns[:len(jobs)], conns[len(jobs):]
+            else:
+                logger.debug("setting config zero")
+                self.config_zero()
+                conns0 = self.run_phase(tasks0)
+
+                logger.debug("setting config one")
+                self.config_one()
+                conns1 = self.run_phase(tasks1)
+
+            # Pass results on for merge
+            self.submit_post_connect(jobs, pcss, conns0, conns1)
+
+    def run_phase(self, tasks):
+        """
+        Hand a list of ``(job, pcs, config)`` tasks to the workers and wait
+        until the phase is complete.
+
+        :returns: a list of connection objects in the order of ``tasks``.
+        """
+        logger = logging.getLogger('qofspider')
+
+        deadline = None
+        if self.phase_deadline is not None:
+            deadline = time.monotonic() + self.phase_deadline
+        phase = Phase(tasks, deadline)
+
+        if self.engine == 'event':
+            # one slice of the batch per engine thread
+            step = -(-len(tasks) // self.engine_threads)
+            for start in range(0, len(tasks), step):
+                self.phasequeue.put((phase, range(start, min(start + step, len(tasks)))))
+        else:
+            for i in range(len(tasks)):
+                self.phasequeue.put((phase, (i,)))
+
+        while not phase.wait(QUEUE_SLEEP):
+            if not self.running:
+                break
+
+        # connects not completed in time count as timed out
+        conns = phase.conns
+        expired = 0
+        for i, conn in enumerate(conns):
+            if conn is None:
+                job, pcs, config = tasks[i]
+                conns[i] = self.expire_connect(job, pcs, config)
+                expired += 1
+
+        if expired > 0:
+            logger.warning("{} of {} connects did not complete before the phase deadline".format(expired, len(tasks)))
+
+        return conns
 
     def config_zero(self):
         raise NotImplementedError("Cannot instantiate an abstract Qofspider")
@@ -182,56 +1080,169 @@ class QofSpider:
         while self.running:
             if self.check_interrupt():
                 logger.warn("qofspider is being interrupted")
-                logger.warn("trying to abort %d jobs", self.jobqueue.qsize())
-                while not self.jobqueue.empty():
-                    self.jobqueue.get()
-                    self.jobqueue.task_done()
+                self.abort_jobs()
                 self.stop()
                 break
             time.sleep(5)
 
-    def worker(self):
+    def abort_jobs(self):
+        """
+        Drop all jobs which have not been picked up by a worker yet.
+        """
         logger = logging.getLogger('qofspider')
+        logger.warn("trying to abort %d jobs", self.jobqueue.qsize())
 
+        # stop the feeder, and drop the sources it has not started on
+        self.job_aborts += 1
+        try:
+            while True:
+                self.job_sources.get_nowait()
+                self.job_sources.task_done()
+        except queue.Empty:
+            pass
+
+        self.jobqueue.clear()
+
+    def feeder(self):
+        """
+        Thread which moves jobs from the sources passed to :meth:`add_jobs`
+        to the job queue, keeping at most ``JOB_BACKLOG`` jobs queued.
+        """
         while self.running:
             try:
-                job = self.jobqueue.get_nowait()
-                logger.debug("got a job: "+repr(job))
+                source = self.job_sources.get(timeout=QUEUE_SLEEP)
             except queue.Empty:
-                #logger.debug("no job available, sleeping")
-                # spin the semaphores
-                self.sem_config_zero.acquire()
-                time.sleep(QUEUE_SLEEP)
-                self.sem_config_one_rdy.release()
-                self.sem_config_one.acquire()
-                time.sleep(QUEUE_SLEEP)
-                self.sem_config_zero_rdy.release()
-            else:
-                # Hook for preconnection
-                pcs = self.pre_connect(job)
+                continue
 
-                # Wait for configuration zero
-                self.sem_config_zero.acquire()
+            aborts = self.job_aborts
+            try:
+                for job in source:
+                    # block until the backlog has room, or the source is dropped
+                    queued = False
+                    while not queued and self.running and self.job_aborts == aborts:
+                        try:
+                            self.queue_job(job, timeout=QUEUE_SLEEP)
+                            queued = True
+                        except queue.Full:
+                            pass
+                    if not queued:
+                        break
+            finally:
+                self.job_sources.task_done()
+
+    def worker(self, shard=0):
+        """
+        Worker thread of the thread engine. Takes one job from ``shard``
+        per configurator round and connects it in each configuration.
+        """
+        logger = logging.getLogger('qofspider')
+
+        if self.concurrent_configs:
+            loop = ConnectLoop(self)
+            connect_all = loop.connect_all
+        else:
+            loop = None
+            connect_all = lambda tasks: [self.connect_or_skip(*task) for task in tasks]
+
+        while self.running:
+            jobs = self.next_jobs(1, shard)
+            if len(jobs) == 0:
+                continue
+
+            logger.debug("got a job: "+repr(jobs[0]))
+
+            pcss, conns0, conns1 = self.connect_round(jobs, connect_all)
+
+            # Pass results on for merge
+            self.post_connect_job(jobs[0], pcss[0], conns0[0], conns1[0])
+
+        if loop is not None:
+            loop.close()
+
+    def event_worker(self, shard=0):
+        """
+        Worker thread of the event engine. Takes a batch of jobs from
+        ``shard`` per configurator round and connects all of them at once for each
+        configuration. post_connect runs on a thread pool, so that slow
+        post-connection work does not hold up the next round.
+        """
+        logger = logging.getLogger('qofspider')
+
+        loop = ConnectLoop(self)
+        batch_size = max(1, self.worker_count // self.engine_threads)
+
+        while self.running:
+            jobs = self.next_jobs(batch_size, shard)
+            if len(jobs) == 0:
+                continue
+
+            logger.debug("got a batch of {} jobs".format(len(jobs)))
+
+            pcss, conns0, conns1 = self.connect_round(jobs, loop.connect_all)
+
+            # Pass results on for merge
+            self.submit_post_connect(jobs, pcss, conns0, conns1)
 
-                # Connect in configuration zero
-                conn0 = self.connect(job, pcs, 0)
+        loop.close()
 
-                # Wait for configuration one
-                self.sem_config_one_rdy.release()
-                self.sem_config_one.acquire()
+    def phase_worker(self):
+        """
+        Worker thread of the thread engine for the 'phase' scheduler.
+        """
+        while self.running:
+            try:
+                phase, indices = self.phasequeue.get(timeout=QUEUE_SLEEP)
+            except queue.Empty:
+                continue
+
+            for i in indices:
+                if phase.closed:
+                    break
+
+                job, pcs, config = phase.tasks[i]
+                conn = self.connect_or_skip(job, pcs, config)
+                if not phase.complete(i, conn):
+                    # too late for this phase, just clean up
+                    self.discard_connect(job, conn, pcs, config)
+
+    def phase_event_worker(self):
+        """
+        Worker thread of the event engine for the 'phase' scheduler.
+        """
+        loop = ConnectLoop(self)
+
+        while self.running:
+            try:
+                phase, indices = self.phasequeue.get(timeout=QUEUE_SLEEP)
+            except queue.Empty:
+                continue
 
-                # Connect in configuration one
-                conn1 = self.connect(job, pcs, 1)
+            if phase.closed:
+                continue
 
-                # Signal okay to go to configuration zero
-                self.sem_config_zero_rdy.release()
+            tasks = [phase.tasks[i] for i in indices]
+            conns = loop.connect_all(tasks, deadline=phase.deadline)
+            for i, (job, pcs, config), conn in zip(indices, tasks, conns):
+                if not phase.complete(i, conn):
+                    # too late for this phase, just clean up
+                    self.discard_connect(job, conn, pcs, config)
+
+        loop.close()
+
+    def post_connect_job(self, job, pcs, conn0, conn1):
+        logger = logging.getLogger('qofspider')
 
-                # Pass results on for merge
-                self.resqueue.put(self.post_connect(job, conn0, pcs, 0))
-                self.resqueue.put(self.post_connect(job, conn1, pcs, 1))
+        self.resqueue.put(self.post_connect(job, conn0, pcs, 0))
+        self.resqueue.put(self.post_connect(job, conn1, pcs, 1))
 
-                logger.debug("job complete: "+repr(job))
-                self.jobqueue.task_done()
+        logger.debug("job complete: "+repr(job))
+        self.jobqueue.task_done(job)
+
+    def job_shard(self, job):
+        """
+        Return the shard to queue job in, see ``job_shards``.
+        """
+        return 0
 
     def pre_connect(self, job):
         pass
@@ -239,6 +1250,59 @@ class QofSpider:
     def connect(self, job, pcs, config):
         raise NotImplementedError("Cannot instantiate an abstract Qofspider")
 
+    def connect_or_skip(self, job, pcs, config):
+        conn = self.skip_connect(job, pcs, config)
+        if conn is None:
+            conn = self.connect(job, pcs, config)
+        return conn
+
+    def skip_connect(self, job, pcs, config):
+        """
+        Hook called before each connect. Return a connection object to pass
+        to :meth:`post_connect` instead of connecting at all, or None to
+        connect. Configuration one of a job is only started after its
+        configuration zero completed, unless configurations run concurrently.
+        """
+        return None
+
+    def start_connect(self, job, pcs, config):
+        """
+        Non-blocking counterpart of :meth:`connect` used by the event engine.
+
+        :returns: a tuple ``(sock, err)`` of a non-blocking socket and the
+                  return value of its :meth:`socket.socket.connect_ex` call.
+        """
+        raise NotImplementedError("Cannot instantiate an abstract Qofspider")
+
+    def finish_connect(self, job, pcs, config, sock, err):
+        """
+        Turn a socket started by :meth:`start_connect` into the connection
+        object that :meth:`post_connect` expects.
+
+        :param err: 0 if the connect succeeded, an errno if it failed, or
+                    None if it timed out.
+        """
+        raise NotImplementedError("Cannot instantiate an abstract Qofspider")
+
+    def connect_timeout(self, job, pcs, config):
+        raise NotImplementedError("Cannot instantiate an abstract Qofspider")
+
+    def expire_connect(self, job, pcs, config):
+        """
+        Return the connection object passed to :meth:`post_connect` for a
+        connect which did not complete before the phase deadline.
+        """
+        raise NotImplementedError("Cannot instantiate an abstract Qofspider")
+
+    def discard_connect(self, job, conn, pcs, config):
+        """
+        Release a connection object which completed after its phase was
+        closed, and so under an unknown configuration. Its result has
+        already been given by :meth:`expire_connect`, so no post-connection
+        work must be done on it.
+        """
+        raise NotImplementedError("Cannot instantiate an abstract Qofspider")
+
     def post_connect(self, job, conn, pcs, config):
         raise NotImplementedError("Cannot instantiate an abstract Qofspider")
 
@@ -281,12 +1345,18 @@ class QofSpider:
             logger = logging.getLogger('qofspider')
             logger.info("connection from "+str(self.client_address))
 
-            msr = ipfix.reader.from_stream(self.rfile)
+            spider = self.server.spider
+            if spider.collector == 'compiled':
+                reader = FlowReader(spider.compile_tupleizer, spider.tupleize_flow)
+                for tf in reader.iterator(self.rfile):
+                    spider.flowqueue.put(tf)
+            else:
+                msr = ipfix.reader.from_stream(self.rfile)
 
-            for d in msr.namedict_iterator():
-                tf = self.server.spider.tupleize_flow(d)
-                if tf:
-                    self.server.spider.flowqueue.put(tf)
+                for d in msr.namedict_iterator():
+                    tf = spider.tupleize_flow(d)
+                    if tf:
+                        spider.flowqueue.put(tf)
 
             logger.info("connection from "+str(self.client_address)+ "terminated")
 
@@ -309,48 +1379,158 @@ class QofSpider:
     def tupleize_flow(self, flow):
         raise NotImplementedError("Cannot instantiate an abstract Qofspider")
 
+    def compile_tupleizer(self, tmpl):
+        """
+        Compile a decoder for records of the given IPFIX template, for use
+        by the 'compiled' collector. See :class:`FlowReader`.
+
+        :returns: a ``(struct, convert)`` pair, or None to decode records
+                  of this template as dicts and pass them to tupleize_flow.
+        """
+        return None
+
     def merger(self):
+        """
+        Thread which joins flows and results on their merge key. Takes
+        everything waiting in both queues in bulk, and blocks until one of
+        them receives an item when both are empty.
+        """
         logger = logging.getLogger('qofspider')
+
+        stats_time = time.monotonic()
+        stats_count = self.merge_count
+
         while self.running:
-            if self.flowqueue.qsize() >= self.resqueue.qsize():
-                try:
-                    flow = self.flowqueue.get_nowait()
-                except queue.Empty:
-                    time.sleep(QUEUE_SLEEP)
+            flows = self.flowqueue.get_all(MERGE_BATCH)
+            results = self.resqueue.get_all(MERGE_BATCH)
 
-                else:
-                    flowkey = (flow.ip, flow.port)
-                    logger.debug("got a flow ("+str(flow.ip)+", "+str(flow.port)+")")
-
-                    if flowkey in self.restab:
-                        logger.debug("merging flow")
-                        self.merge(flow, self.restab[flowkey])
-                        del self.restab[flowkey]
-                    elif flowkey in self.flowtab:
-                        logger.debug("won't merge duplicate flow")
-                    else:
-                        self.flowtab[flowkey] = flow
-
-                    self.flowqueue.task_done()
+            if len(flows) == 0 and len(results) == 0:
+                self.merge_wakeup.wait(QUEUE_SLEEP)
+                self.merge_wakeup.clear()
             else:
-                try:
-                    res = self.resqueue.get_nowait()
-                except queue.Empty:
-                    time.sleep(QUEUE_SLEEP)
-                else:
-                    reskey = (res.ip, res.port)
-                    logger.debug("got a result ("+str(res.ip)+", "+str(res.port)+")")
+                now = time.monotonic()
+                for flow in flows:
+                    self.merge_flow(flow, now)
+                self.flowqueue.task_done_n(len(flows))
+
+                for res in results:
+                    self.merge_result(res, now)
+                self.resqueue.task_done_n(len(results))
+
+            now = time.monotonic()
+            self.evict(now - self.table_ttl)
+
+            if now - stats_time >= MERGE_STATS_INTERVAL:
+                self.merge_rate = (self.merge_count - stats_count) / (now - stats_time)
+                stats_time = now
+                stats_count = self.merge_count
+                logger.debug("merger: "+repr(self.merger_stats()))
+
+    def merge_key(self, rec):
+        """
+        Return the key on which flows and results are joined.
+        """
+        return (rec.ip, rec.port)
+
+    def merge_flow(self, flow, now):
+        flowkey = self.merge_key(flow)
+
+        entry = self.restab.pop(flowkey, None)
+        if entry is not None:
+            self.merge(flow, entry[1])
+            self.merge_count += 1
+        elif flowkey in self.flowtab:
+            self.merge_duplicates += 1
+        else:
+            self.flowtab[flowkey] = (now, flow)
 
-                    if reskey in self.flowtab:
-                        logger.debug("merging result")
-                        self.merge(self.flowtab[reskey], res)
-                        del self.flowtab[reskey]
-                    elif reskey in self.restab:
-                        logger.debug("won't merge duplicate result")
-                    else:
-                        self.restab[reskey] = res
+    def merge_result(self, res, now):
+        if not self.expects_flow(res):
+            self.unmatched(res)
+            return
+
+        reskey = self.merge_key(res)
+
+        entry = self.flowtab.pop(reskey, None)
+        if entry is not None:
+            self.merge(entry[1], res)
+            self.merge_count += 1
+        elif reskey in self.restab:
+            self.merge_duplicates += 1
+        else:
+            self.restab[reskey] = (now, res)
+
+    def expects_flow(self, res):
+        """
+        Return False for results which no flow will be merged with, e.g.
+        because no connection was attempted. These are passed straight on
+        to :meth:`unmatched`.
+        """
+        return True
+
+    def evict(self, before):
+        """
+        Evict unmatched flows and results which arrived before ``before``,
+        or which exceed the table size.
+        """
+        while len(self.restab) > 0:
+            key, (stamp, res) = next(iter(self.restab.items()))
+            if stamp < before:
+                reason = 'result_ttl'
+            elif len(self.restab) > self.table_size:
+                reason = 'result_size'
+            else:
+                break
+
+            del self.restab[key]
+            self.evictions[reason] += 1
+            self.unmatched(res)
+
+        while len(self.flowtab) > 0:
+            key, (stamp, flow) = next(iter(self.flowtab.items()))
+            if stamp < before:
+                reason = 'flow_ttl'
+            elif len(self.flowtab) > self.table_size:
+                reason = 'flow_size'
+            else:
+                break
+
+            del self.flowtab[key]
+            self.evictions[reason] += 1
+
+    def flush_tables(self):
+        """
+        Pass on all remaining unmatched results and drop all unmatched flows.
+        """
+        for stamp, res in self.restab.values():
+            self.unmatched(res)
+        self.evictions['result_flush'] += len(self.restab)
+        self.evictions['flow_flush'] += len(self.flowtab)
+
+        self.restab.clear()
+        self.flowtab.clear()
+
+    def unmatched(self, res):
+        """
+        Hook for results which could not be merged with a flow.
+        """
+        raise NotImplementedError("Cannot instantiate an abstract Qofspider")
 
-                    self.resqueue.task_done()
+    def merger_stats(self):
+        """
+        :returns: a dict with the number of merged records and duplicates,
+                  the merge rate per second over the last interval, the
+                  backlog of queued and unmatched flows and results, and
+                  the number of evicted entries per reason.
+        """
+        return {'merged': self.merge_count,
+                'duplicates': self.merge_duplicates,
+                'rate': self.merge_rate,
+                'flowqueue': self.flowqueue.qsize(),
+                'resqueue': self.resqueue.qsize(),
+                'flowtab': len(self.flowtab),
+                'restab': len(self.restab),
+                'evictions': dict(self.evictions)}
 
     def merge(self, flow, res):
         raise NotImplementedError("Cannot instantiate an abstract Qofspider")
@@ -399,18 +1579,47 @@ class QofSpider:
             self.merger_thread.start()
             logger.debug("merger up")
 
-            self.configurator_thread = threading.Thread(args=(self.configurator,),
+            self.feeder_thread = threading.Thread(args=(self.feeder,),
                              target=self.exception_wrapper,
-                             name="configurator",
+                             name="feeder",
                              daemon=True)
-            self.configurator_thread.start()
-            logger.debug("configurator up")
+            self.feeder_thread.start()
+
+            if self.scheduler == 'phase':
+                configurator = self.phaser
+                worker = self.phase_event_worker if self.engine == 'event' else self.phase_worker
+            else:
+                configurator = self.configurator
+                worker = self.event_worker if self.engine == 'event' else self.worker
+
+            if self.concurrent_configs:
+                # configuration is chosen per connection, on top of config zero
+                self.config_zero()
+                if configurator == self.configurator:
+                    configurator = None
+
+            if configurator is not None:
+                self.configurator_thread = threading.Thread(args=(configurator,),
+                                 target=self.exception_wrapper,
+                                 name="configurator",
+                                 daemon=True)
+                self.configurator_thread.start()
+                logger.debug("configurator up")
+
+            if self.engine == 'event' or self.scheduler == 'phase':
+                self.post_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ENGINE_POST_WORKERS)
 
             self.worker_threads = []
-            for i in range(self.worker_count):
-                t = threading.Thread(args=(self.worker,), target=self.exception_wrapper, name='worker_{}'.format(i), daemon=True)
-                self.worker_threads.append(t)
-                t.start()
+            if self.engine == 'event':
+                for i in range(self.engine_threads):
+                    t = threading.Thread(args=(self.shard_worker(worker, i),), target=self.exception_wrapper, name='engine_{}'.format(i), daemon=True)
+                    self.worker_threads.append(t)
+                    t.start()
+            else:
+                for i in range(self.worker_count):
+                    t = threading.Thread(args=(self.shard_worker(worker, i),), target=self.exception_wrapper, name='worker_{}'.format(i), daemon=True)
+                    self.worker_threads.append(t)
+                    t.start()
 
             logger.debug("workers up")
 
@@ -419,6 +1628,14 @@ class QofSpider:
                 self.interrupter_thread.start()
                 logger.debug("interrupter up")
 
+    def shard_worker(self, worker, i):
+        """
+        Bind the ``i``-th worker thread to a shard, round-robin.
+        """
+        if self.job_shards == 1:
+            return worker
+        return lambda: worker(i % self.job_shards)
+
     def terminate(self):
         if self.terminating:
             return
@@ -428,6 +1645,7 @@ class QofSpider:
         logger.error("terminating qofspider.")
 
         self.running = False
+        self.job_arrival.set()
 
         # terminate qof, close listeners, join all threads
         try:
@@ -443,10 +1661,12 @@ class QofSpider:
         # empty all queues, so that stop() does not hang up.
         try:
             while True:
-                self.jobqueue.task_done()
+                self.job_sources.task_done()
         except ValueError:
             pass
 
+        self.jobqueue.abandon()
+
         try:
             while True:
                 self.resqueue.task_done()
@@ -465,6 +1685,9 @@ class QofSpider:
         if threading.current_thread() != self.qofowner_thread:
             self.qofowner_thread.join()
 
+        if self.feeder_thread is not None and threading.current_thread() != self.feeder_thread:
+            self.feeder_thread.join()
+
         for worker in self.worker_threads:
             if threading.current_thread() != worker:
                 worker.join()
@@ -472,7 +1695,7 @@ class QofSpider:
         if threading.current_thread() != self.qoflistener_thread:
             self.qoflistener_thread.join()
 
-        if threading.current_thread() != self.configurator_thread:
+        if self.configurator_thread is not None and threading.current_thread() != self.configurator_thread:
             self.configurator_thread.join()
 
         if self.interrupter_thread is not None and threading.current_thread() != self.interrupter_thread:
@@ -481,6 +1704,9 @@ class QofSpider:
         if threading.current_thread() != self.merger_thread:
             self.merger_thread.join()
 
+        if self.post_executor is not None:
+            self.post_executor.shutdown(wait=False)
+
     def stop(self):
         logger = logging.getLogger('qofspider')
 
@@ -490,7 +1716,8 @@ class QofSpider:
             # Set stopping flag
             self.stopping = True
 
-            # Wait for job and result queues to empty
+            # Wait for job sources, job and result queues to empty
+            self.job_sources.join()
             self.jobqueue.join()
             self.resqueue.join()
             logger.debug("job and result queues empty")
@@ -516,15 +1743,32 @@ class QofSpider:
             # Shut down threads
             self.running = False
             self.stopping = False
+            self.job_arrival.set()
 
             # join threads
             self.join_threads()
 
+            # pass on whatever did not find a partner
+            self.flush_tables()
+
+            logger.info("merger: "+repr(self.merger_stats()))
+
     def add_job(self, job):
         if self.stopping or self.terminating:
             return
 
-        self.jobqueue.put(job)
+        self.queue_job(job)
+
+    def add_jobs(self, jobs):
+        """
+        Add all jobs from an iterable. The iterable is consumed by the
+        feeder thread while the spider runs, so it may be a generator over
+        a target list which is never held in memory as a whole.
+        """
+        if self.stopping or self.terminating:
+            return
+
+        self.job_sources.put(iter(jobs))
 
     def terminate_qof(self):
         # We need to hack this, since it runs as root and you can't kill it
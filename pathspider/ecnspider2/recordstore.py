@@ -0,0 +1,154 @@
+"""
+Ecnspider2: Qofspider-based tool for measuring ECN-linked connectivity
+Derived from ECN Spider (c) 2014 Damiano Boppart <hat.guy.repo@gmail.com>
+
+Columnar storage for merged records. A chunk of 100k targets yields 200k
+merged records; as namedtuples holding ipaddress objects and Python ints
+these take several hundred bytes each. The store keeps every field in a
+typed array instead, and rebuilds records only when iterated.
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+
+from ipaddress import ip_address
+from array import array
+import threading
+
+from .ecnspider import MergedRecord
+
+# bytes per address slot, large enough for IPv6
+IP_SLOT = 16
+
+# fixed-width columns and their array typecodes
+INT_COLUMNS = [("port", 'H'), ("rport", 'H'), ("ecnstate", 'B'),
+               ("connstate", 'B'), ("httpstatus", 'H'), ("early", 'B'),
+               ("tls", 'B')]
+# tls column: no handshake attempted, handshake failed, handshake completed
+TLS_NONE, TLS_FAILED, TLS_OK = 0, 1, 2
+
+# bit of each other int column in the null mask of a record
+NULL_BITS = {name: 1 << i for i, (name, _) in enumerate(INT_COLUMNS) if name != "tls"}
+
+FLOW_COLUMNS = [("octets", 'Q'), ("fif", 'H'), ("fsf", 'H'), ("fuf", 'H'),
+                ("fir", 'H'), ("fsr", 'H'), ("fur", 'H'), ("ttl", 'B')]
+
+class RecordStore:
+    """
+    Columnar store for MergedRecords.
+
+    Addresses are kept packed in a single bytearray, ports, states and TCP
+    flags in typed arrays. Records without flow data (see
+    :meth:`QofSpider.unmatched`) are marked in the ``flow`` column and
+    come back with their flow fields set to None. Other fields which are
+    None, e.g. the port of a skipped connect or the status of an HTTP
+    request which was never sent, are marked in the ``nulls`` column by
+    their bit in ``NULL_BITS`` and come back as None. Host names and user
+    values are kept as object references, which are shared with the job.
+
+    :meth:`append` can be passed to a spider as its result sink; it may be
+    called from the merger thread while another thread reads the store.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.ipver = array('B')
+        self.ips = bytearray()
+        self.host = []
+        self.userval = []
+        self.flow = array('B')
+        self.nulls = array('B')
+        self.columns = {}
+        for name, typecode in INT_COLUMNS + FLOW_COLUMNS:
+            self.columns[name] = array(typecode)
+
+    def __len__(self):
+        return len(self.ipver)
+
+    def append(self, rec):
+        ip = rec.ip if hasattr(rec.ip, "packed") else ip_address(rec.ip)
+
+        with self.lock:
+            self.ipver.append(ip.version)
+            self.ips += ip.packed.ljust(IP_SLOT, b'\0')
+            self.host.append(rec.host)
+            self.userval.append(rec.userval)
+
+            nulls = 0
+            for name, _ in INT_COLUMNS:
+                value = getattr(rec, name)
+                if name == "tls":
+                    self.columns[name].append(TLS_NONE if value is None else
+                                              TLS_OK if value else TLS_FAILED)
+                elif value is None:
+                    nulls |= NULL_BITS[name]
+                    self.columns[name].append(0)
+                else:
+                    self.columns[name].append(int(value))
+            self.nulls.append(nulls)
+
+            has_flow = rec.fif is not None
+            self.flow.append(has_flow)
+            for name, _ in FLOW_COLUMNS:
+                self.columns[name].append(getattr(rec, name) if has_flow else 0)
+
+    def take(self):
+        """
+        Move all records into a new store and return it, leaving this
+        store empty. Used to export records while the spider still adds.
+        """
+        taken = RecordStore()
+        with self.lock:
+            for name in ("ipver", "ips", "host", "userval", "flow", "nulls", "columns"):
+                setattr(taken, name, getattr(self, name))
+            self.clear()
+
+        return taken
+
+    def ip(self, i):
+        """Return the address of record ``i`` as an ipaddress object."""
+        start = i * IP_SLOT
+        length = 4 if self.ipver[i] == 4 else 16
+        return ip_address(bytes(self.ips[start:start+length]))
+
+    def record(self, i):
+        """Rebuild record ``i`` as a MergedRecord."""
+        values = {name: self.columns[name][i] for name, _ in INT_COLUMNS}
+        nulls = self.nulls[i]
+        if nulls:
+            for name, bit in NULL_BITS.items():
+                if nulls & bit:
+                    values[name] = None
+        if values["connstate"] is not None:
+            values["connstate"] = bool(values["connstate"])
+        values["tls"] = None if values["tls"] == TLS_NONE else values["tls"] == TLS_OK
+
+        for name, _ in FLOW_COLUMNS:
+            values[name] = self.columns[name][i] if self.flow[i] else None
+
+        return MergedRecord(ip=self.ip(i), host=self.host[i],
+                            userval=self.userval[i], **values)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.record(i)
+
+    def nbytes(self):
+        """Return the number of bytes held by the fixed-width columns."""
+        return (len(self.ips) + len(self.ipver) + len(self.flow) + len(self.nulls) +
+                sum(len(col) * col.itemsize for col in self.columns.values()))
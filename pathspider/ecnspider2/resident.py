@@ -0,0 +1,169 @@
+"""
+Ecnspider2: Qofspider-based tool for measuring ECN-linked connectivity
+Derived from ECN Spider (c) 2014 Damiano Boppart <hat.guy.repo@gmail.com>
+
+Resident spider: keeps QoF, the collector and the workers running across
+mPlane invocations, so that a chunk does not pay for starting and
+stopping them.
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+
+import threading
+import logging
+import time
+
+from . import qofspider
+
+# seconds a chunk may go without a record, on top of the merge table ttl
+# and two connection timeouts, before it is given up
+RESIDENT_GRACE = 10
+
+class Chunk:
+    def __init__(self, store):
+        self.store = store
+        self.expected = 0
+        self.fed = False
+        self.count = 0
+        self.arrived = threading.Event()
+
+    def tag(self, jobs, number):
+        """Tag jobs with the chunk number, counting the records to expect."""
+        for job in jobs:
+            self.expected += 2
+            yield job._replace(userval=number)
+        self.fed = True
+        self.arrived.set()
+
+    def complete(self):
+        return self.fed and self.count >= self.expected
+
+class ResidentSpider:
+    """
+    Keeps a single spider running across service invocations.
+
+    Each invocation is a chunk: its jobs are tagged with a chunk number in
+    their ``userval``, and merged records are routed back to the record
+    store of their chunk. A chunk is complete when both records of each of
+    its jobs have arrived. Results which cannot have a flow are passed on
+    at once (see :meth:`QofSpider.expects_flow`); those which should but
+    never see one arrive once the merger evicts them (see ``table_ttl``).
+    If a chunk receives nothing for longer than that, it is returned with
+    the records it has.
+
+    Only one spider runs at a time; asking for another spider class, or
+    for the same one with other arguments, stops the running spider first.
+    """
+
+    def __init__(self, local_ip4=None, local_ip6=None):
+        self.local_ip4 = local_ip4
+        self.local_ip6 = local_ip6
+        self.spider = None
+        self.spider_kwargs = None
+        self.lock = threading.Lock()
+        self.chunks = {}
+        self.next_chunk = 0
+        self.dropped = 0
+
+    def route(self, rec):
+        with self.lock:
+            chunk = self.chunks.get(rec.userval)
+            if chunk is None:
+                self.dropped += 1
+                return
+            chunk.count += 1
+
+        chunk.store.append(rec._replace(userval=None))
+        chunk.arrived.set()
+
+    def acquire(self, spider_class, spider_kwargs):
+        logger = logging.getLogger('qofspider')
+
+        if self.spider is not None:
+            if type(self.spider) is spider_class and self.spider_kwargs == spider_kwargs and \
+               not self.spider.terminating:
+                return self.spider
+            logger.info("resident spider settings changed, restarting")
+            self.stop()
+
+        self.spider_kwargs = spider_kwargs
+
+        spider_kwargs = dict(spider_kwargs, local_ip4=self.local_ip4,
+                             local_ip6=self.local_ip6, check_interrupt=None)
+        self.spider = spider_class(self.route, **spider_kwargs)
+        self.spider.run()
+        logger.info("resident spider up: "+spider_class.__name__)
+
+        return self.spider
+
+    def run_chunk(self, spider_class, spider_kwargs, jobs, store, check_interrupt=None):
+        """
+        Run jobs on the resident spider and add their records to store.
+        """
+        logger = logging.getLogger('qofspider')
+
+        # the spider runs with the settings of this invocation
+        spider = self.acquire(spider_class, spider_kwargs)
+        stall = spider.table_ttl + 2 * spider.conn_timeout + RESIDENT_GRACE
+
+        with self.lock:
+            number = self.next_chunk
+            self.next_chunk += 1
+            chunk = Chunk(store)
+            self.chunks[number] = chunk
+
+        try:
+            spider.add_jobs(chunk.tag(jobs, number))
+
+            last_arrival = time.monotonic()
+            while not chunk.complete():
+                if spider.exception is not None:
+                    exception = spider.exception
+                    self.stop()
+                    raise exception
+
+                if check_interrupt is not None and check_interrupt():
+                    logger.warn("chunk %d is being interrupted", number)
+                    spider.abort_jobs()
+                    break
+
+                if chunk.arrived.wait(qofspider.QUEUE_SLEEP):
+                    chunk.arrived.clear()
+                    last_arrival = time.monotonic()
+                elif time.monotonic() - last_arrival > stall:
+                    logger.warn("chunk %d stalled with %d of %d records",
+                                number, chunk.count, chunk.expected)
+                    break
+        finally:
+            with self.lock:
+                del self.chunks[number]
+
+    def shutdown(self):
+        """Drop queued jobs and stop the spider, along with QoF."""
+        if self.spider is not None and not self.spider.terminating:
+            self.spider.abort_jobs()
+        self.stop()
+
+    def stop(self):
+        if self.spider is None:
+            return
+
+        spider, self.spider = self.spider, None
+        self.spider_kwargs = None
+        if not spider.terminating:
+            spider.stop()
+        logging.getLogger('qofspider').info(
+                "resident spider stopped, dropped {} late records".format(self.dropped))
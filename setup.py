@@ -93,4 +93,8 @@ setup(
             'pathspider=pathspider:main',
         ],
     },
+
+    # bin/ecnspider-tcp-ecn is not installed as a script: it is run as root
+    # through sudo, so it has to be installed by root to a root-owned
+    # location (see README.md).
 )
@@ -2,4 +2,4 @@
 
 pylint setup.py pathspider
 #pep8 setup.py pathspider
-
+python -m pytest -q tests
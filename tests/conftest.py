@@ -0,0 +1,7 @@
+import os
+import sys
+
+# pathspider loads its registry relative to the working directory
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(here))
+os.chdir(os.path.join(os.path.dirname(here), 'pathspider'))
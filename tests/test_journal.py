@@ -0,0 +1,49 @@
+from ipaddress import ip_address
+
+from pathspider.ecnspider2 import ecnspider
+from pathspider.ecnspider2.journal import Journal
+from pathspider.ecnspider2.recordstore import RecordStore
+
+def record(ip, ecnstate, port=40000, fif=0x02, early=ecnspider.EARLY_NONE):
+    flow = (1200, fif, 0x02, 0x1b, 0x12, 0x12, 0x1b, 50) if fif is not None else (None,) * 8
+    return ecnspider.MergedRecord(ip_address(ip), ip, port, 80, ecnstate, True, 0, None,
+                                  *flow, early, None)
+
+def jobs(ips):
+    return [ecnspider.Job(ip_address(ip), ip, 80, None) for ip in ips]
+
+def test_resume_after_interruption(tmp_path):
+    path = str(tmp_path / 'test.journal')
+
+    jnl = Journal(path, RecordStore())
+    jnl.load()
+    # measured completely
+    jnl.append(record('10.0.0.1', 0))
+    jnl.append(record('10.0.0.1', 1))
+    # configuration one skipped by early exit, without a flow
+    jnl.append(record('10.0.0.2', 0, fif=None, port=0))
+    jnl.append(record('10.0.0.2', 1, fif=None, port=None, early=ecnspider.EARLY_SKIP))
+    # in flight when interrupted: one result flushed without its flow
+    jnl.append(record('10.0.0.3', 0))
+    jnl.append(record('10.0.0.3', 1, fif=None))
+    # in flight when interrupted: only one result in
+    jnl.append(record('10.0.0.4', 0))
+    jnl.close()
+
+    # a crash leaves a truncated entry behind
+    with open(path, 'ab') as f:
+        f.write(b'\xa9\x07')
+
+    store = RecordStore()
+    jnl = Journal(path, store)
+    assert jnl.load() == 4
+    assert sorted(str(rec.ip) for rec in store) == ['10.0.0.1', '10.0.0.1', '10.0.0.2', '10.0.0.2']
+
+    pending = jnl.pending(jobs(['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4', '10.0.0.5']))
+    assert [str(job.ip) for job in pending] == ['10.0.0.3', '10.0.0.4', '10.0.0.5']
+
+    # the journal has been rewritten without the unsettled targets
+    jnl.close()
+    jnl = Journal(path, RecordStore())
+    assert jnl.load() == 4
+    jnl.close(remove=True)
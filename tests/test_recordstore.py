@@ -0,0 +1,32 @@
+from ipaddress import ip_address
+
+from pathspider.ecnspider2 import ecnspider
+from pathspider.ecnspider2.recordstore import RecordStore
+
+def record(ip, port, httpstatus, early, tls, flow=True):
+    flows = (1200, 0x02, 0x02, 0x1b, 0x12, 0x12, 0x1b, 50) if flow else (None,) * 8
+    return ecnspider.MergedRecord(ip_address(ip), 'example.com', port, 443, 1, True, httpstatus, None,
+                                  *flows, early, tls)
+
+def test_round_trip():
+    records = [
+        # measured completely
+        record('10.0.0.1', 40000, 200, ecnspider.EARLY_NONE, True),
+        # zeros are values, not nulls
+        record('10.0.0.2', 40001, 0, ecnspider.EARLY_NONE, False),
+        # skipped by early exit: no port, status or flow
+        record('10.0.0.3', None, None, ecnspider.EARLY_SKIP, None, flow=False),
+        # record from before the early and tls fields existed
+        record('2001:db8::1', 40002, None, None, None),
+    ]
+
+    store = RecordStore()
+    for rec in records:
+        store.append(rec)
+
+    assert len(store) == len(records)
+    assert list(store) == records
+
+    taken = store.take()
+    assert len(store) == 0
+    assert list(taken) == records